@@ -2,15 +2,144 @@
 
 import streamlit as st
 import pandas as pd
-from fuzzywuzzy import fuzz
+import numpy as np
+import openpyxl
+from fuzzywuzzy import utils as fuzz_utils
+from rapidfuzz import fuzz as rapid_fuzz
+from rapidfuzz import process as rapid_process
+from rapidfuzz.distance import DamerauLevenshtein, JaroWinkler, Prefix
 import random
 import re
+import unicodedata
+import os
+import sys
+import hashlib
+import json
+import io
+import math
+import logging
+import threading
+import time
+import glob
+import csv
+import sqlite3
+import multiprocessing
+import heapq
+import itertools
+import bisect
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+try:
+    # Optional (installed with streamlit): multithreaded CSV parsing and Parquet/Feather support
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    # Optional: sparse matrices for the TF-IDF scoring backend
+    import scipy.sparse
+except ImportError:
+    scipy = None
 
 # --- Configuration ---
 # 1. Specify the name of your EXCEL file 
+#    (a directory or glob such as 'knowledge_base/*.xlsx' loads every matching workbook/CSV and all their sheets)
 CSV_FILE_NAME = 'knowledge_base_file.xlsx' 
 # 2. Set the minimum score for a "good" match (0 to 100)
 MIN_MATCH_SCORE = 75
+# 3. Compiled snapshot of the knowledge base written next to the file, so restarts skip parsing it
+#    (an .npz archive of JSON, flat arrays and the frame as Parquet; loading it never unpickles anything)
+SIDECAR_SUFFIX = '.kbcache'
+# Bump whenever the layout of the snapshot (or of the structures stored in it) changes
+SIDECAR_FORMAT_VERSION = 20
+# 4. How often (seconds) the background watcher checks the knowledge base file for changes
+RELOAD_POLL_SECONDS = 5
+# 5. Workbooks larger than this (bytes) are ingested with openpyxl's read-only row iterator,
+#    which keeps the parser's memory flat instead of building the whole sheet's object model
+STREAMING_INGEST_MIN_BYTES = 20 * 1024 * 1024
+# Progress (rows/sec) is logged every this many rows during a streaming ingest
+STREAMING_PROGRESS_ROWS = 50_000
+# 6. File types picked up when CSV_FILE_NAME is a directory or glob, and how many files are parsed in parallel
+KNOWLEDGE_BASE_EXTENSIONS = ('.xlsx', '.xlsm', '.xls', '.csv', '.parquet', '.feather', '.arrow')
+LOAD_WORKERS = min(8, os.cpu_count() or 1)
+# 7. Where the knowledge base is held while serving: 'memory' (pandas) or 'sqlite'
+#    (an on-disk database with FTS5 indexes next to the file, for catalogs larger than RAM)
+STORAGE_BACKEND = 'memory'
+SQLITE_DB_SUFFIX = '.kb.sqlite'
+# Most candidate codes the SQLite backend hands to the fuzzy scorer per query
+SQLITE_MAX_CANDIDATES = 200
+
+# 8. Threads used by the batched fuzzy scorer (-1 = all cores; the scoring itself runs without the GIL)
+SCORING_WORKERS = -1
+# Candidates are scored in chunks of this size, highest score bound first, so that the rest can be skipped
+# as soon as their bound falls below MIN_MATCH_SCORE and the best score found so far
+SCORING_CHUNK_SIZE = 4096
+# 9. Character n-gram index that picks the candidates handed to the fuzzy scorer (memory backend).
+#    'guaranteed' keeps every code that could still reach MIN_MATCH_SCORE, so answers are identical to scoring
+#    the whole catalog (the n-gram size is lowered from NGRAM_SIZE as far as the threshold requires);
+#    'fast' keeps codes sharing a word or at least NGRAM_FAST_OVERLAP of the query's n-grams, and can miss weak matches
+NGRAM_RECALL_MODE = 'guaranteed'
+NGRAM_SIZE = 3
+NGRAM_FAST_OVERLAP = 0.5
+# 10. How many ranked results search() returns by default, and the near misses suggested when nothing reaches
+#     MIN_MATCH_SCORE (at most SUGGESTION_COUNT codes scoring at least SUGGESTION_MIN_SCORE)
+SEARCH_TOP_K = 10
+SUGGESTION_COUNT = 3
+SUGGESTION_MIN_SCORE = 50
+# 11. Answers to recent queries kept in memory and shared by every session (0 entries disables the cache);
+#     entries expire after QUERY_CACHE_TTL_SECONDS and are all dropped when the knowledge base is reloaded
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_TTL_SECONDS = 600
+# 12. Full-text (BM25) search over what each sub code means and does. A row matching the query scores the
+#     idf-weighted share of the query's words it contains times TEXT_SEARCH_WEIGHT, on the same 0-100 scale as
+#     the code/name matches (so a complete text match scores 90, and a code or name match of 90+ still wins)
+TEXT_SEARCH_COLUMNS = ['Meaning of sub code', 'Description of values']
+TEXT_SEARCH_WEIGHT = 0.9
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 13. How codes and setting names are scored against the query (memory backend): 'token_set' (fuzzy
+#     token_set_ratio) or 'tfidf' (cosine similarity of character n-gram TF-IDF vectors, one sparse product per
+#     field for the whole catalog; needs scipy). TF-IDF similarities are mapped linearly onto the token_set scale,
+#     fitted on sample queries drawn from the catalog so that MIN_MATCH_SCORE keeps its meaning
+SCORING_BACKEND = 'token_set'
+TFIDF_NGRAM_SIZE = 3
+TFIDF_CALIBRATION_QUERIES = 300
+TFIDF_CALIBRATION_CHOICES = 2000
+# 14. Type-ahead: how many codes are suggested for a prefix, and how many index entries one lookup may inspect
+AUTOCOMPLETE_LIMIT = 8
+AUTOCOMPLETE_SCAN_LIMIT = 2000
+# 15. Typo-tolerant code lookup: queries of at least TYPO_MIN_LENGTH characters (canonical form) also match the
+#     codes within TYPO_MAX_DISTANCE edits (Damerau-Levenshtein: a transposition such as 410/401 is one edit),
+#     scoring the share of characters not edited on the usual 0-100 scale (one edit in 'PR410' scores 80)
+TYPO_MAX_DISTANCE = 1
+TYPO_MIN_LENGTH = 4
+# 16. Structured code queries ("PR-400 to PR-450", "all SC codes", "codes near 905"): up to STRUCTURED_MAX_DETAILS
+#     matching codes are shown in full, more are listed (the first STRUCTURED_MAX_LISTED) for "show all";
+#     a "near" query returns the NEAR_CODES_COUNT codes numerically closest to its number
+STRUCTURED_MAX_DETAILS = 5
+STRUCTURED_MAX_LISTED = 50
+NEAR_CODES_COUNT = 5
+# 17. Scorer of each search field, by name (see SCORERS): 'token_set' (fuzz.token_set_ratio, served through the
+#     n-gram index and score bounds), 'wratio', 'partial_ratio', 'jaro_winkler' or 'exact_prefix'. A field with
+#     another scorer has all of its candidates scored. Not used by the TF-IDF backend
+CODE_SCORER = 'token_set'
+NAME_SCORER = 'token_set'
+# Scorer benchmark (sidebar): the last SCORER_BENCHMARK_QUERIES served queries (kept in memory, shared by every
+# session), or as many sample queries drawn from the catalog until some are served. A QUERY_LOG_SUFFIX (e.g.
+# '.queries.log') also logs them one per line to a file next to the knowledge base, so they outlive a restart;
+# the file is rotated to '<log>.1' once it reaches QUERY_LOG_MAX_BYTES ('' = no file)
+QUERY_LOG_SUFFIX = ''
+QUERY_LOG_MAX_BYTES = 1_000_000
+SCORER_BENCHMARK_QUERIES = 200
+# 18. Sharded search (memory backend, token_set scoring): catalogs of at least SHARDED_SEARCH_MIN_CODES codes are
+#     split into SEARCH_SHARDS contiguous shards, each held and scored by its own persistent worker process, so a
+#     query no longer holds this process's GIL while it is scored (0 = never shard)
+SEARCH_SHARDS = min(8, os.cpu_count() or 1)
+SHARDED_SEARCH_MIN_CODES = 200_000
 
 # --- Conversational Responses ---
 GREETINGS = ["hi", "hello", "hey", "good morning", "good afternoon"]
@@ -32,6 +161,12 @@ AMBIGUOUS_SHOW_ALL_SNIPPET = (
     "Displaying details for all the highly-matched 08 Codes below:"
 )
 CSV_NOT_FOUND_SNIPPET = "I couldn't find a close match for that 08 Code or query in my knowledge base. Could you try rephrasing or check the exact code or setting name?"
+SUGGESTIONS_SNIPPET = "The closest entries I have are:"
+STRUCTURED_MATCH_SNIPPET = "Matching 08 Codes: {count}"
+STRUCTURED_LIST_SNIPPET = (
+    "{count} 08 Codes match that request. "
+    "Please search for one of the 08 Codes below (or say \"show all\") for the full details:"
+)
 
 # --- REQUIRED COLUMNS ---
 REQUIRED_COLUMNS = [
@@ -40,45 +175,2372 @@ REQUIRED_COLUMNS = [
     'Sub Code',
     'Meaning of sub code'
 ]
+# Optional columns kept on load; every other column is skipped by the readers
+OPTIONAL_COLUMNS = [
+    'Description of values',
+]
+LOADED_COLUMNS = REQUIRED_COLUMNS + OPTIONAL_COLUMNS
+# Added on load: which file (and sheet) each row came from
+SOURCE_COLUMN = 'Source'
+
+# --- File Formats ---
+# Leading bytes identifying each supported format; anything else falls back to the file extension
+FILE_FORMAT_MAGIC = [
+    (b'PK\x03\x04', 'excel'),         # .xlsx/.xlsm (zip container)
+    (b'\xd0\xcf\x11\xe0', 'excel'),   # legacy .xls (OLE2 container)
+    (b'PAR1', 'parquet'),
+    (b'ARROW1', 'feather'),          # Feather v2 / Arrow IPC file
+]
+FILE_FORMAT_BY_EXTENSION = {
+    '.xlsx': 'excel',
+    '.xlsm': 'excel',
+    '.xls': 'excel',
+    '.parquet': 'parquet',
+    '.feather': 'feather',
+    '.arrow': 'feather',
+}
 
 # --- Helper Patterns ---
 # Regex pattern to detect a "Show All" command
 SHOW_ALL_PATTERN = r'\b(show all|all options|give all|all of them)\b'
 # Regex pattern to extract codes from the Ambiguous Search Result block
 CODE_EXTRACTION_PATTERN = r'\* `([A-Z0-9-]+)`'
+# Separators ignored when comparing Access Codes: whitespace, ASCII and Unicode dashes, '_', '.', '/'
+CODE_SEPARATOR_PATTERN = r'[\s\-_./\u2010-\u2015\u2212]+'
+# Expected shape of an Access Code (family prefix, dash, number); other codes are flagged on load
+ACCESS_CODE_PATTERN = r'[A-Z]{1,4}-\d{1,5}'
+# Family prefix and number of a canonical Access Code ('PR401' -> 'PR', 401)
+CODE_PARTS_PATTERN = r'([A-Z]+)(\d+)'
+# Structured queries over code families and numbers (matched case-insensitively):
+# a range ("PR-400 to PR-450", "pr 400..450", or "PR-400 - PR-450" with a dash and the family on both ends, since
+# 'PR-443-01' is a code and a sub code), a whole family ("all SC codes") and a neighbourhood ("codes near 905")
+RANGE_QUERY_PATTERN = (
+    r'\b([a-z]{1,4})\s*[-_]?\s*(\d{1,5})\s*'
+    r'(?:(?:(?:to|through|thru|until)\b|\.\.)\s*(?:([a-z]{1,4})\s*[-_]?\s*)?|[-\u2013\u2014]\s*([a-z]{1,4})\s*[-_]?\s*)'
+    r'(\d{1,5})\b'
+)
+FAMILY_QUERY_PATTERN = r'\b(?:all|every|list)\s+(?:of\s+)?(?:the\s+)?([a-z]{1,4})\s*-?\s*codes?\b'
+NEAR_QUERY_PATTERN = r'\b(codes?\s+)?(?:near|around|close\s+to)\s+(?:([a-z]{1,4})\s*[-_]?\s*)?(\d{1,5})\b'
+# How many offending codes per check the data-quality report lists
+QUALITY_REPORT_SAMPLES = 20
+
+
+logger = logging.getLogger(__name__)
 
 
 # --- Core Functions ---
 
+class KnowledgeBaseError(Exception):
+    """Raised when the knowledge base cannot be loaded. The message (and optional hint) is shown to the user."""
+
+    def __init__(self, message, hint=None):
+        super().__init__(message)
+        self.hint = hint
+
+    def __reduce__(self):
+        # Keep the hint when the error crosses a process boundary (see load_data)
+        return (KnowledgeBaseError, (str(self), self.hint))
+
+def check_required_columns(file_path, columns):
+    """Raises KnowledgeBaseError if any of REQUIRED_COLUMNS is missing from the given header."""
+    if not all(col in columns for col in REQUIRED_COLUMNS):
+        missing_cols = [col for col in REQUIRED_COLUMNS if col not in columns]
+        raise KnowledgeBaseError(f"Error: The file '{file_path}' is missing required columns: {', '.join(missing_cols)}. Please check the column headers.")
+
+def header_name(name):
+    """A header cell as every reader matches it against the expected column names: surrounding whitespace ignored."""
+    return str(name).strip()
+
+def resolve_source_files(source):
+    """
+    Expands the configured knowledge base source into the list of files to load.
+    A directory yields every supported file inside it, a glob every supported match, anything else itself.
+    """
+    if os.path.isdir(source):
+        candidates = [os.path.join(source, name) for name in os.listdir(source)]
+    elif any(char in source for char in '*?['):
+        candidates = glob.glob(source)
+    else:
+        return [source]
+
+    return sorted(
+        path for path in candidates
+        if os.path.isfile(path)
+        and path.lower().endswith(KNOWLEDGE_BASE_EXTENSIONS)
+        and not os.path.basename(path).startswith('~$')  # Excel lock files
+    )
+
+def require_source_files(file_path):
+    """Like resolve_source_files, but raises KnowledgeBaseError when a directory or glob matches nothing."""
+    files = resolve_source_files(file_path)
+    if not files:
+        raise KnowledgeBaseError(f"Error: No knowledge base files ({', '.join(KNOWLEDGE_BASE_EXTENSIONS)}) were found for '{file_path}'.")
+    return files
+
+def uses_streaming_ingest(file_path):
+    """True if the file is an .xlsx/.xlsm workbook large enough to go through stream_excel."""
+    if not file_path.lower().endswith(('.xlsx', '.xlsm')):
+        return False
+    try:
+        return os.path.getsize(file_path) >= STREAMING_INGEST_MIN_BYTES
+    except OSError:
+        return False
+
+def stream_excel(file_path):
+    """
+    Reads every sheet with openpyxl's read-only row iterator and returns {sheet name: DataFrame}.
+    Each header is validated before any of its data rows are read, and rows are appended column by column,
+    so beyond the resulting frames the ingest only holds the parser's fixed-size buffers.
+    """
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    sheets = {}
+    try:
+        for worksheet in workbook.worksheets:
+            rows = worksheet.iter_rows(values_only=True)
+            header = next(rows, None) or ()
+            positions = {header_name(name): i for i, name in enumerate(header) if name is not None}
+            if not positions:
+                continue  # Blank sheet
+            label = file_path if len(workbook.worksheets) == 1 else f"{file_path}:{worksheet.title}"
+            check_required_columns(label, positions)
+            positions = {name: i for name, i in positions.items() if name in LOADED_COLUMNS}
+
+            columns = {name: [] for name in positions}
+            row_count = 0
+            started = time.perf_counter()
+            for row in rows:
+                if all(value is None for value in row):
+                    continue
+                for name, i in positions.items():
+                    columns[name].append(row[i] if i < len(row) else None)
+                row_count += 1
+                if row_count % STREAMING_PROGRESS_ROWS == 0:
+                    elapsed = time.perf_counter() - started
+                    logger.info("Streaming '%s': %d rows (%.0f rows/sec)", label, row_count, row_count / max(elapsed, 1e-9))
+            sheets[worksheet.title] = pd.DataFrame(columns, dtype=object)
+    finally:
+        workbook.close()
+    return sheets
+
+def detect_file_format(file_path):
+    """Returns 'excel', 'parquet', 'feather' or 'csv', from the file's magic bytes and then its extension."""
+    with open(file_path, 'rb') as f:
+        head = f.read(8)
+    for magic, file_format in FILE_FORMAT_MAGIC:
+        if head.startswith(magic):
+            return file_format
+    return FILE_FORMAT_BY_EXTENSION.get(os.path.splitext(file_path)[1].lower(), 'csv')
+
+def _require_pyarrow(file_format):
+    if pyarrow is None:
+        raise ImportError(f"reading {file_format} files requires pyarrow")
+
+def read_csv_fast(file_path):
+    """Reads a CSV as text, projecting LOADED_COLUMNS; uses pyarrow's multithreaded parser when available."""
+    with open(file_path, newline='', encoding='utf-8-sig') as f:
+        header = next(csv.reader(f), [])
+    check_required_columns(file_path, [header_name(name) for name in header])
+
+    usecols = [name for name in header if header_name(name) in LOADED_COLUMNS]
+    # Read as text so codes such as '0801' and '00' keep their leading zeros. pandas' pyarrow engine infers the
+    # column types first and applies dtype=str afterwards, so pyarrow's reader is given the types itself.
+    if pyarrow is None:
+        return pd.read_csv(file_path, dtype=str, usecols=usecols)
+    convert_options = pyarrow.csv.ConvertOptions(
+        column_types={name: pyarrow.string() for name in usecols}, include_columns=usecols, strings_can_be_null=True,
+    )
+    return pyarrow.csv.read_csv(file_path, convert_options=convert_options).to_pandas()
+
+def read_parquet_fast(file_path):
+    """Reads only LOADED_COLUMNS from a Parquet file, validating the schema before touching any data."""
+    _require_pyarrow('Parquet')
+    names = pyarrow.parquet.read_schema(file_path).names
+    check_required_columns(file_path, [header_name(name) for name in names])
+    return pd.read_parquet(file_path, columns=[name for name in names if header_name(name) in LOADED_COLUMNS])
+
+def read_feather_fast(file_path):
+    """Reads only LOADED_COLUMNS from a Feather/Arrow IPC file, validating the schema before touching any data."""
+    _require_pyarrow('Feather')
+    with pyarrow.ipc.open_file(file_path) as reader:
+        names = reader.schema.names
+    check_required_columns(file_path, [header_name(name) for name in names])
+    return pd.read_feather(file_path, columns=[name for name in names if header_name(name) in LOADED_COLUMNS])
+
+def describe_reader(file_path):
+    """Short name of the reader read_source_file uses for the file, for the load statistics."""
+    try:
+        file_format = detect_file_format(file_path)
+    except OSError:
+        return 'unknown'
+    if file_format == 'excel':
+        return 'excel (streaming)' if uses_streaming_ingest(file_path) else 'excel'
+    if file_format == 'csv' and pyarrow is not None:
+        return 'csv (pyarrow)'
+    return file_format
+
+def _cell_text(value):
+    # Whole numbers print without '.0', as Excel displays them
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def as_text_columns(df):
+    """
+    Returns the frame with every column as text (object columns of str, blank cells stay missing) whatever the
+    reader, so merged sources agree: a workbook's numeric sub code 1 and a CSV's '1' are the same value.
+    """
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.StringDtype):
+            df[column] = df[column].astype(object)
+        else:
+            df[column] = df[column].map(_cell_text, na_action='ignore').astype(object)
+    return df
+
+def read_source_file(file_path):
+    """
+    Reads one workbook (every sheet), CSV, Parquet or Feather file with the fastest reader for its format,
+    and returns its validated frames tagged with SOURCE_COLUMN.
+    Runs in a worker process when several files are loaded at once, so it must not touch the page.
+    """
+    try:
+        file_format = detect_file_format(file_path)
+        if file_format == 'csv':
+            sheets = {None: read_csv_fast(file_path)}
+        elif file_format == 'parquet':
+            sheets = {None: read_parquet_fast(file_path)}
+        elif file_format == 'feather':
+            sheets = {None: read_feather_fast(file_path)}
+        elif uses_streaming_ingest(file_path):
+            sheets = stream_excel(file_path)
+        else:
+            sheets = pd.read_excel(file_path, sheet_name=None, usecols=lambda name: header_name(name) in LOADED_COLUMNS, dtype=object)
+    except KnowledgeBaseError:
+        raise
+    except FileNotFoundError:
+        raise KnowledgeBaseError(f"Error: The file '{file_path}' was not found. Please ensure it is an Excel file (.xlsx or .xls) and correctly named.")
+    except Exception as e:
+        raise KnowledgeBaseError(
+            f"An error occurred while loading the Excel file: {e}",
+            hint="Ensure the file structure is correct and necessary libraries (pandas, openpyxl) and tabulate are installed.",
+        )
+
+    frames = []
+    for sheet_name, df in sheets.items():
+        if df.columns.empty:
+            continue  # Blank sheet
+        label = file_path if len(sheets) == 1 else f"{file_path}:{sheet_name}"
+        df = df.rename(columns=header_name)
+        check_required_columns(label, df.columns)
+        df = as_text_columns(df)
+        df[SOURCE_COLUMN] = os.path.basename(label)
+        frames.append(df)
+
+    if not frames:
+        check_required_columns(file_path, [])
+    return frames
+
+def spawn_target(function):
+    """
+    Returns a module-level function as a spawned process looks it up (by name). Streamlit runs this script in a
+    fresh __main__ module on every rerun, so a function held by an object from an earlier run (e.g. the watcher's
+    knowledge base) is not the one pickle finds under its name any more.
+    """
+    return getattr(sys.modules.get(function.__module__), function.__qualname__, function)
+
+def _make_load_pool(task_count):
+    """
+    Process pool for parsing several files at once (openpyxl holds the GIL). Workers are spawned, not forked:
+    reloads run on the watcher thread, and a child forked from a threaded process can inherit a held lock.
+    """
+    workers = max(1, min(task_count, LOAD_WORKERS))
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
 def load_data(file_path):
-    """Loads the Excel file into a Pandas DataFrame."""
+    """
+    Loads the Excel file (or every file and sheet of a directory/glob) into a single Pandas DataFrame.
+    Files are parsed in parallel and every row keeps its provenance in SOURCE_COLUMN.
+    Raises KnowledgeBaseError instead of writing to the page, so it can also run off the script thread.
+    """
+    files = require_source_files(file_path)
+    if len(files) == 1:
+        results = [read_source_file(files[0])]
+    else:
+        with _make_load_pool(len(files)) as pool:
+            results = list(pool.map(spawn_target(read_source_file), files))
+
+    frames = [df for file_frames in results for df in file_frames]
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
+
+def compact_knowledge_base(df):
+    """
+    Returns (frame, code_offsets): the rows grouped by Access Code, with codes in first-seen order and
+    each code's rows in file order. Every text column is stored as a categorical, so each distinct string
+    (code, setting name, meaning, description...) is held once in a pool and rows only store small integers.
+    The rows of the i-th code are frame.iloc[code_offsets[i]:code_offsets[i + 1]].
+    Rows without an Access Code are kept after the last code's rows.
+    """
+    codes = pd.Categorical(df['Access Code'], categories=pd.unique(df['Access Code'].dropna()))
+    code_count = len(codes.categories)
+    sort_key = np.where(codes.codes < 0, code_count, codes.codes)
+    order = np.argsort(sort_key, kind='stable')
+
+    frame = df.iloc[order].reset_index(drop=True)
+    for column in frame.columns:
+        if column == 'Access Code':
+            frame[column] = pd.Categorical(frame[column], categories=codes.categories)
+        elif not pd.api.types.is_numeric_dtype(frame[column]):
+            frame[column] = frame[column].astype('category')
+
+    counts = np.bincount(codes.codes[codes.codes >= 0], minlength=code_count)
+    code_offsets = np.zeros(code_count + 1, dtype=np.int64)
+    np.cumsum(counts, out=code_offsets[1:])
+    return frame, code_offsets
+
+def hash_codes(frame, code_offsets):
+    """Returns {Access Code: digest of all its rows}, used to tell which codes a reload actually changed."""
+    row_hashes = pd.util.hash_pandas_object(frame, index=False).to_numpy()
+    return {
+        code: hashlib.blake2b(row_hashes[code_offsets[i]:code_offsets[i + 1]].tobytes(), digest_size=16).hexdigest()
+        for i, code in enumerate(frame['Access Code'].cat.categories)
+    }
+
+def canonicalize_code(text):
+    """
+    Canonical form used for exact Access Code lookups: full-width characters folded (NFKC), upper-cased,
+    separators removed. 'PR-401', 'pr401', 'PR 401' and 'Ｐｒ－４０１' all become 'PR401'.
+    """
+    return re.sub(CODE_SEPARATOR_PATTERN, '', unicodedata.normalize('NFKC', str(text)).upper())
+
+def preprocess_text(text):
+    """
+    Applies, once, exactly the processing fuzz.token_set_ratio(query.lower(), str(value).lower()) used to do
+    on every call: lower-case, drop non-ASCII characters, turn other non-alphanumerics into spaces, trim.
+    """
+    return fuzz_utils.full_process(str(text).lower(), force_ascii=True)
+
+def batch_token_set_ratio(processed_query, processed_choices):
+    """
+    Scores one preprocessed query against every preprocessed choice in a single batched rapidfuzz call.
+    Returns integer scores identical to fuzzywuzzy's token_set_ratio (same processing, same rounding).
+    """
+    return _batch_scores(processed_query, processed_choices, rapid_fuzz.token_set_ratio)
+
+def _batch_scores(query, choices, scorer, scale=1):
+    """
+    Scores one query against every choice with a rapidfuzz scorer in a single cdist call, rounded like fuzzywuzzy
+    (after multiplying by `scale`, for scorers returning 0-1 similarities).
+    """
+    if not query or not choices:
+        return np.zeros(len(choices), dtype=np.int64)
+    scores = rapid_process.cdist(
+        [query], choices, scorer=scorer, processor=None, dtype=np.float64, workers=SCORING_WORKERS,
+    )[0]
+    return np.rint(scores * scale).astype(np.int64)
+
+def batch_wratio(processed_query, processed_choices):
+    """fuzz.WRatio of the query against every choice (best of the plain, partial and token ratios, weighted)."""
+    return _batch_scores(processed_query, processed_choices, rapid_fuzz.WRatio)
+
+def batch_partial_ratio(processed_query, processed_choices):
+    """fuzz.partial_ratio of the query against every choice: the best-matching substring of the longer one."""
+    return _batch_scores(processed_query, processed_choices, rapid_fuzz.partial_ratio)
+
+def batch_jaro_winkler(processed_query, processed_choices):
+    """Jaro-Winkler similarity (favouring a shared start) of the query against every choice, on the 0-100 scale."""
+    return _batch_scores(processed_query, processed_choices, JaroWinkler.normalized_similarity, scale=100)
+
+def batch_exact_prefix(processed_query, processed_choices):
+    """
+    Choices equal to the query score 100, choices starting with it the share of their length it covers, others 0.
+    One cdist call gives every choice's common-prefix length with the query; only the choices it covers are measured.
+    """
+    scores = np.zeros(len(processed_choices), dtype=np.int64)
+    if not processed_query or not len(processed_choices):
+        return scores
+    prefix_lengths = rapid_process.cdist(
+        [processed_query], processed_choices, scorer=Prefix.similarity, processor=None, dtype=np.int32, workers=SCORING_WORKERS,
+    )[0]
+    prefixed = np.flatnonzero(prefix_lengths == len(processed_query))
+    lengths = np.array([len(processed_choices[i]) for i in prefixed], dtype=np.float64)
+    scores[prefixed] = np.rint(100 * len(processed_query) / lengths)
+    return scores
+
+def batch_token_set_ratio_presorted(query_token_set, token_sets, shares_word):
+    """
+    batch_token_set_ratio on precomputed token-set strings (see token_set_string), given which choices share a word
+    with the query. For the others token_set_ratio is exactly the plain ratio of the two token-set strings, so they
+    are scored with fuzz.ratio and their words are never split, de-duplicated or sorted again.
+    """
+    scores = np.zeros(len(token_sets), dtype=np.int64)
+    shares_word = np.asarray(shares_word, dtype=bool)
+    for scorer, selected in ((rapid_fuzz.token_set_ratio, np.flatnonzero(shares_word)), (rapid_fuzz.ratio, np.flatnonzero(~shares_word))):
+        if len(selected):
+            scores[selected] = _batch_scores(query_token_set, [token_sets[i] for i in selected], scorer)
+    return scores
+
+def token_set_string(processed):
+    """The de-duplicated, sorted words of a preprocessed string: what token_set_ratio compares when no word is shared."""
+    return ' '.join(sorted(set(processed.split())))
+
+def count_ngrams(text, size):
+    """Returns the multiset of character n-grams of the text, padded with a space on both sides."""
+    padded = f" {text} "
+    return Counter(padded[i:i + size] for i in range(len(padded) - size + 1))
+
+def recall_safe_ngram_size(min_score, max_size):
+    """
+    Largest n-gram size (up to max_size, at most 3) whose shared-n-gram bound below still rules codes out at
+    min_score: with n-grams of size q the bound grows with the strings' lengths only while (2q-1)*r/2 > q-1,
+    so a threshold of 75 needs bigrams and trigrams need more than 80.
+    """
+    ratio = (min_score - 0.5) / 100
+    for size in range(min(max_size, 3), 1, -1):
+        if (2 * size - 1) * ratio / 2 > size - 1:
+            return size
+    return 1
+
+def required_shared_ngrams(query_length, lengths, size, min_score):
+    """
+    Fewest n-grams (per candidate, vectorized over their lengths) a candidate sharing no word with the query must
+    share with it to possibly score min_score. Without a shared word token_set_ratio is the plain ratio of the two
+    token-set strings, i.e. 2*LCS/(len_x+len_y); every deleted character destroys at most q of the query's padded
+    n-grams and every insertion point at most q-1, and what survives is shared.
+    """
+    ratio = (min_score - 0.5) / 100
+    # Shortest common subsequence of the padded strings that still rounds up to min_score
+    common = np.ceil(ratio * (query_length + lengths) / 2 - 1e-9) + 2
+    padded_query, padded_lengths = query_length + 2, lengths + 2
+    return padded_query - size + 1 - size * (padded_query - common) - (size - 1) * (padded_lengths - common)
+
+def build_ngram_index(token_sets, size, mode=NGRAM_RECALL_MODE, min_score=MIN_MATCH_SCORE):
+    """
+    Builds the inverted index for one search field as plain data (so it is stored in the sidecar):
+    n-gram -> (positions, counts) and word -> positions over the field's token-set strings, plus their lengths.
+    """
+    gram_postings, token_postings = {}, {}
+    lengths = np.empty(len(token_sets), dtype=np.int64)
+    for position, text in enumerate(token_sets):
+        lengths[position] = len(text)
+        for gram, count in count_ngrams(text, size).items():
+            positions, counts = gram_postings.setdefault(gram, ([], []))
+            positions.append(position)
+            counts.append(count)
+        for token in text.split():
+            token_postings.setdefault(token, []).append(position)
+    return {
+        'size': size,
+        'mode': mode,
+        'min_score': min_score,
+        'grams': {gram: (np.array(positions, dtype=np.int32), np.array(counts, dtype=np.int32)) for gram, (positions, counts) in gram_postings.items()},
+        'tokens': {token: np.array(positions, dtype=np.int32) for token, positions in token_postings.items()},
+        'lengths': lengths,
+    }
+
+def invert_positions(previous_positions, previous_count):
+    """Maps each previous code position to its current one (-1 for codes not carried over), given the reverse map."""
+    new_of_old = np.full(previous_count, -1, dtype=np.int64)
+    kept = np.flatnonzero(previous_positions >= 0)
+    new_of_old[previous_positions[kept]] = kept
+    return new_of_old
+
+def carry_over(previous_values, previous_positions, compute, inputs):
+    """
+    Per-code values: the previous version's for codes carried over unchanged (previous_positions >= 0, see
+    KnowledgeBase._match_unchanged), compute(input) for the others and for every code of a first load.
+    """
+    if previous_positions is None:
+        return [compute(value) for value in inputs]
+    return [previous_values[old] if old >= 0 else compute(value) for old, value in zip(previous_positions.tolist(), inputs)]
+
+def remap_postings(postings, new_of_old):
+    """
+    Renumbers postings ({key: positions} or {key: (positions, payload...)}) through new_of_old, dropping the
+    positions it maps to -1 and the keys left empty. All postings are remapped in one vectorized pass.
+    """
+    keys = list(postings)
+    if not keys:
+        return {}
+    is_tuple = isinstance(postings[keys[0]], tuple)
+    columns = [postings[key] if is_tuple else (postings[key],) for key in keys]
+    lengths = np.array([len(column[0]) for column in columns], dtype=np.int64)
+    flat = [np.concatenate([column[i] for column in columns]) for i in range(len(columns[0]))]
+    positions = new_of_old[flat[0]]
+    keep = positions >= 0
+    flat = [positions[keep].astype(flat[0].dtype)] + [values[keep] for values in flat[1:]]
+    bounds = np.searchsorted(np.repeat(np.arange(len(keys)), lengths)[keep], np.arange(len(keys) + 1))
+    remapped = {}
+    for k, key in enumerate(keys):
+        start, end = bounds[k], bounds[k + 1]
+        if start < end:
+            remapped[key] = tuple(values[start:end] for values in flat) if is_tuple else flat[0][start:end]
+    return remapped
+
+def merge_postings(postings, extra):
+    """A new postings dict with extra's positions (and payloads) appended to those of the same key."""
+    merged = dict(postings)
+    for key, value in extra.items():
+        if key not in merged:
+            merged[key] = value
+        elif isinstance(value, tuple):
+            merged[key] = tuple(np.concatenate(pair) for pair in zip(merged[key], value))
+        else:
+            merged[key] = np.concatenate((merged[key], value))
+    return merged
+
+def update_ngram_index(index, previous_positions, token_sets):
+    """
+    The n-gram index over token_sets given the previous version's index (left untouched): postings of codes carried
+    over (previous_positions >= 0) are renumbered, only the other codes are indexed afresh.
+    """
+    new_of_old = invert_positions(previous_positions, len(index['lengths']))
+    fresh = np.flatnonzero(previous_positions < 0)
+    fresh_index = build_ngram_index([token_sets[i] for i in fresh], index['size'], index['mode'], index['min_score'])
+    return {
+        'size': index['size'],
+        'mode': index['mode'],
+        'min_score': index['min_score'],
+        'grams': merge_postings(remap_postings(index['grams'], new_of_old), remap_postings(fresh_index['grams'], fresh)),
+        'tokens': merge_postings(remap_postings(index['tokens'], new_of_old), remap_postings(fresh_index['tokens'], fresh)),
+        'lengths': np.array([len(text) for text in token_sets], dtype=np.int64),
+    }
+
+def ngram_candidates(index, processed_query, min_score=None):
+    """
+    Returns (positions, shares_word): the positions worth scoring against the query, and which of them share a
+    word with it. Those are always kept (n-grams cannot bound token_set_ratio then), the others only when they
+    share enough n-grams, as the index's recall mode defines it.
+    In 'guaranteed' mode nothing that could reach min_score (default: the threshold the index was built for) is
+    dropped; a lower min_score than the index was tuned for just retrieves more candidates.
+    """
+    text = token_set_string(processed_query)
+    if not text:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=bool)
+    lengths = index['lengths']
+    shares_word = np.zeros(len(lengths), dtype=bool)
+    for token in text.split():
+        positions = index['tokens'].get(token)
+        if positions is not None:
+            shares_word[positions] = True
+
+    query_grams = count_ngrams(text, index['size'])
+    shared = np.zeros(len(lengths), dtype=np.int64)
+    for gram, query_count in query_grams.items():
+        postings = index['grams'].get(gram)
+        if postings is not None:
+            positions, counts = postings
+            shared[positions] += np.minimum(counts, query_count)
+
+    if index['mode'] == 'guaranteed':
+        required = required_shared_ngrams(len(text), lengths, index['size'], index['min_score'] if min_score is None else min_score)
+    else:
+        required = max(1, int(np.ceil(NGRAM_FAST_OVERLAP * sum(query_grams.values()))))
+    keep = shares_word | (shared >= required)
+    return np.flatnonzero(keep), shares_word[keep]
+
+def score_bounds(query_length, lengths, shares_word):
+    """
+    Upper bounds on the token_set_ratio of the query against candidates, from the token-set string lengths alone.
+    Sharing a word, a candidate can score 100; otherwise its score is the plain ratio of the two token-set strings,
+    at most 2*min(len_x, len_y)/(len_x+len_y).
+    """
+    total = query_length + lengths
+    bounds = np.rint(200 * np.minimum(query_length, lengths) / np.maximum(total, 1)).astype(np.int64)
+    return np.where(shares_word, 100, bounds)
+
+def score_fields_with_pruning(processed_query, fields, count, min_score=MIN_MATCH_SCORE, top=None):
+    """
+    Scores the query against per-field candidates, skipping those that provably cannot matter.
+    `fields` holds, per search field, (token-set strings by position, candidate positions, token-set lengths and
+    shares_word of those candidates). Candidates are scored in descending-bound chunks; once a chunk's bound falls below
+    min_score (and, with `top`, below the top-th best code score so far, ties included) the rest are pruned.
+    Returns (one score array of length count per field, 0 where not scored, and the pruning stats).
+    """
+    field_scores = [np.zeros(count, dtype=np.int64) for _ in fields]
+    query_token_set = token_set_string(processed_query)
+    query_length = len(query_token_set)
+    field_ids = np.concatenate([np.full(len(positions), f, dtype=np.int64) for f, (_, positions, _, _) in enumerate(fields)])
+    positions = np.concatenate([np.asarray(positions, dtype=np.int64) for _, positions, _, _ in fields])
+    shares_word = np.concatenate([np.asarray(shares_word, dtype=bool) for _, _, _, shares_word in fields])
+    bounds = score_bounds(query_length, np.concatenate([np.asarray(lengths, dtype=np.int64) for _, _, lengths, _ in fields]), shares_word)
+    order = np.argsort(-bounds, kind='stable')
+
+    scored = 0
+    threshold = max(min_score, 1)
+    scored_positions = []
+    for start in range(0, len(order), SCORING_CHUNK_SIZE):
+        chunk = order[start:start + SCORING_CHUNK_SIZE]
+        chunk = chunk[bounds[chunk] >= threshold]
+        if not len(chunk):
+            break
+        for f, (token_sets, _, _, _) in enumerate(fields):
+            field_chunk = chunk[field_ids[chunk] == f]
+            if len(field_chunk):
+                chunk_positions = positions[field_chunk]
+                field_scores[f][chunk_positions] = batch_token_set_ratio_presorted(
+                    query_token_set, [token_sets[i] for i in chunk_positions], shares_word[field_chunk],
+                )
+        scored += len(chunk)
+        if top == 1:
+            threshold = max(threshold, max(int(scores[positions[chunk]].max()) for scores in field_scores))
+        elif top is not None:
+            # Raise the threshold to the top-th best code score so far (codes tied with it are still scored)
+            scored_positions.append(positions[chunk])
+            touched = np.unique(np.concatenate(scored_positions))
+            if len(touched) >= top:
+                best_scores = np.maximum.reduce([scores[touched] for scores in field_scores])
+                threshold = max(threshold, int(np.partition(best_scores, len(touched) - top)[len(touched) - top]))
+
+    stats = {'fields': count * len(fields), 'candidates': len(order), 'scored': scored, 'pruned': len(order) - scored}
+    return field_scores, stats
+
+# Batched scorers selectable per search field (CODE_SCORER, NAME_SCORER): (preprocessed query, preprocessed
+# values) -> integer scores 0-100
+SCORERS = {
+    'token_set': batch_token_set_ratio,
+    'wratio': batch_wratio,
+    'partial_ratio': batch_partial_ratio,
+    'jaro_winkler': batch_jaro_winkler,
+    'exact_prefix': batch_exact_prefix,
+}
+
+def get_field_scorers():
+    """Returns the configured (Access Code, Setting Item Name) scorer names; raises KnowledgeBaseError for an unknown one."""
+    for setting, name in (('CODE_SCORER', CODE_SCORER), ('NAME_SCORER', NAME_SCORER)):
+        if name not in SCORERS:
+            raise KnowledgeBaseError(
+                f"Error: {setting} = '{name}' is not a known scorer.",
+                hint=f"Choose one of: {', '.join(SCORERS)}.",
+            )
+    return CODE_SCORER, NAME_SCORER
+
+def score_fields_with_scorers(processed_query, scorer_names, values, pruning_fields, count, min_score=MIN_MATCH_SCORE, top=None):
+    """
+    Scores each search field with its scorer: token_set fields through score_fields_with_pruning (pruning_fields[f]
+    is that field's entry for it), every other field by one batched scan of values[f], its preprocessed values.
+    Returns (one score array of length count per field, stats) like score_fields_with_pruning.
+    """
+    token_set_fields = [f for f, name in enumerate(scorer_names) if name == 'token_set']
+    if token_set_fields:
+        pruned_scores, stats = score_fields_with_pruning(processed_query, [pruning_fields[f] for f in token_set_fields], count, min_score, top)
+    else:
+        pruned_scores, stats = [], {'fields': 0, 'candidates': 0, 'scored': 0, 'pruned': 0}
+    field_scores = []
+    for f, name in enumerate(scorer_names):
+        if name == 'token_set':
+            field_scores.append(pruned_scores[token_set_fields.index(f)])
+        else:
+            field_scores.append(SCORERS[name](processed_query, values[f]))
+            stats['candidates'] += count
+            stats['scored'] += count
+    stats['fields'] = count * len(scorer_names)
+    return field_scores, stats
+
+def score_catalog_fields(processed_query, scorer_names, token_sets_by_field, ngram_indexes, values_by_field, min_score=MIN_MATCH_SCORE, top=None):
+    """
+    score_fields_with_scorers over a catalog (or a shard of one) held in memory: token_set fields take their
+    candidates from the field's n-gram index, other fields are scored in full from their preprocessed values.
+    """
+    fields = []
+    for scorer_name, token_sets, index in zip(scorer_names, token_sets_by_field, ngram_indexes):
+        if scorer_name != 'token_set':
+            fields.append(None)
+            continue
+        candidates, shares_word = ngram_candidates(index, processed_query, min_score)
+        fields.append((token_sets, candidates, index['lengths'][candidates], shares_word))
+    return score_fields_with_scorers(processed_query, scorer_names, values_by_field, fields, len(token_sets_by_field[0]), min_score, top)
+
+def get_query_log_path(file_path=CSV_FILE_NAME):
+    """Returns where the served queries of a knowledge base are logged (see log_query), or None if logging is off."""
+    return get_sidecar_path(file_path, QUERY_LOG_SUFFIX) if QUERY_LOG_SUFFIX else None
+
+@st.cache_resource
+def get_served_queries():
+    """The last SCORER_BENCHMARK_QUERIES served queries of this process, shared by every session."""
+    return deque(maxlen=SCORER_BENCHMARK_QUERIES)
+
+def log_query(query, file_path=CSV_FILE_NAME):
+    """
+    Records a served query for the scorer benchmark, and appends it to the query log file if one is configured;
+    file failures (e.g. a read-only directory) only cost the samples kept across restarts.
+    """
+    line = ' '.join(str(query).split())
+    if not line:
+        return
+    get_served_queries().append(line)
+    log_path = get_query_log_path(file_path)
+    if log_path is None:
+        return
     try:
-        df = pd.read_excel(file_path)
-        
-        if not all(col in df.columns for col in REQUIRED_COLUMNS):
-            missing_cols = [col for col in REQUIRED_COLUMNS if col not in df.columns]
-            st.error(f"Error: The file '{file_path}' is missing required columns: {', '.join(missing_cols)}. Please check the column headers.")
+        with open(log_path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+            full = f.tell() >= QUERY_LOG_MAX_BYTES
+        if full:
+            os.replace(log_path, log_path + '.1')
+    except OSError:
+        pass
+
+def load_benchmark_queries(processed_fields, count=SCORER_BENCHMARK_QUERIES, seed=0):
+    """
+    Returns (queries, source) for benchmark_scorers: the last `count` queries served by this process, else the
+    last `count` of the query log file (at most QUERY_LOG_MAX_BYTES), else sample queries drawn from the catalog
+    (see _perturb_sample_query).
+    """
+    served = list(get_served_queries())[-count:]
+    if served:
+        return served, 'served queries'
+    log_path = get_query_log_path()
+    try:
+        with open(log_path or '', encoding='utf-8') as f:
+            queries = deque((line.strip() for line in f if line.strip()), maxlen=count)
+        if queries:
+            return list(queries), os.path.basename(log_path)
+    except OSError:
+        pass
+    rng = random.Random(seed)
+    populated = [value for values in processed_fields for value in values if value]
+    if not populated:
+        return [], 'catalog samples'
+    return [_perturb_sample_query(rng.choice(populated), rng) for _ in range(count)], 'catalog samples'
+
+def benchmark_scorers(processed_fields, queries, baseline='token_set'):
+    """
+    Scores both fields of every code with each scorer in SCORERS for each query. Returns, per scorer, the
+    queries/sec and the share of queries on which its decision agrees with `baseline`'s: the same codes sharing
+    the best score at or above MIN_MATCH_SCORE, or no match for both.
+    """
+    decisions = {}
+    results = []
+    for name in [baseline] + [name for name in SCORERS if name != baseline]:
+        scorer = SCORERS[name]
+        started = time.perf_counter()
+        scorer_decisions = []
+        for query in queries:
+            processed_query = preprocess_text(query)
+            scores = np.maximum.reduce([scorer(processed_query, values) for values in processed_fields])
+            best_score = int(scores.max()) if len(scores) else 0
+            scorer_decisions.append(tuple(np.flatnonzero(scores == best_score).tolist()) if best_score >= MIN_MATCH_SCORE else None)
+        seconds = time.perf_counter() - started
+        decisions[name] = scorer_decisions
+        agreement = sum(a == b for a, b in zip(scorer_decisions, decisions[baseline])) / len(queries) if queries else 1.0
+        results.append({'scorer': name, 'queries_per_second': len(queries) / seconds if seconds else 0.0, 'agreement': agreement})
+    return results
+
+def text_search_terms(text):
+    """Words of a meaning, description or query as BM25 terms: preprocessed words with a plural 's' stripped."""
+    return [
+        word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word
+        for word in preprocess_text(text).split()
+    ]
+
+def build_text_index(frame, row_count, columns=TEXT_SEARCH_COLUMNS):
+    """
+    Builds the BM25 index over the first row_count rows as plain data: term -> (rows, BM25 weights) and term -> idf.
+    A posting's weight depends only on the term's frequency in the row and the row's length, so it is computed
+    here and a query only sums the postings of its terms.
+    """
+    vocabulary = {}
+    pairs = text_index_pairs(frame, np.arange(row_count), vocabulary, columns)
+    return finish_text_index(list(vocabulary), *pairs, row_count)
+
+def update_text_index(index, frame, code_offsets, previous_offsets, previous_positions, columns=TEXT_SEARCH_COLUMNS):
+    """
+    The BM25 index of the current rows given the previous version's index (left untouched): the (term, row) pairs of
+    codes carried over (previous_positions >= 0) are renumbered, only the other codes' rows are tokenized. Weights
+    and idf depend on the whole collection and are recomputed from the pairs.
+    """
+    kept = np.flatnonzero(previous_positions >= 0)
+    new_row_of_old = np.full(index['rows'], -1, dtype=np.int64)
+    new_row_of_old[code_rows(previous_offsets, previous_positions[kept])] = code_rows(code_offsets, kept)
+    pair_rows = new_row_of_old[index['pair_rows']]
+    keep = pair_rows >= 0
+
+    vocabulary = {word: term for term, word in enumerate(index['words'])}
+    fresh_terms, fresh_rows, fresh_frequencies = text_index_pairs(frame, code_rows(code_offsets, np.flatnonzero(previous_positions < 0)), vocabulary, columns)
+    terms = np.concatenate((index['pair_terms'][keep], fresh_terms))
+    rows = np.concatenate((pair_rows[keep], fresh_rows))
+    frequencies = np.concatenate((index['frequencies'][keep], fresh_frequencies))
+    order = np.lexsort((rows, terms))
+    return finish_text_index(list(vocabulary), terms[order], rows[order], frequencies[order], int(code_offsets[-1]))
+
+def code_rows(code_offsets, positions):
+    """Row numbers of the codes at `positions`, code after code (each code's rows in order)."""
+    positions = np.asarray(positions, dtype=np.int64)
+    starts = code_offsets[positions]
+    counts = code_offsets[positions + 1] - starts
+    return np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+def text_index_pairs(frame, rows, vocabulary, columns=TEXT_SEARCH_COLUMNS):
+    """
+    Returns (terms, rows, frequencies): every distinct (term id, row) pair among the given rows with the term's count
+    in the row, sorted by term then row. Term ids come from `vocabulary` (term -> id), which new terms are added to.
+    Each distinct cell value is tokenized once.
+    """
+    row_parts, term_parts = [], []
+    for column in columns:
+        if column not in frame.columns:
+            continue
+        value_codes, values = pd.factorize(frame[column].iloc[rows])
+        value_terms = [[vocabulary.setdefault(term, len(vocabulary)) for term in text_search_terms(value)] for value in values]
+        term_counts = np.array([len(terms) for terms in value_terms], dtype=np.int64)
+        flat_terms = np.array([term for terms in value_terms for term in terms], dtype=np.int64)
+        value_starts = np.concatenate([[0], np.cumsum(term_counts)[:-1]]).astype(np.int64)
+
+        valued = np.flatnonzero(value_codes >= 0)
+        counts = term_counts[value_codes[valued]]
+        # Every (row, term) occurrence: the terms of each row's value, laid out row after row
+        offsets_in_value = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        row_parts.append(np.repeat(rows[valued], counts))
+        term_parts.append(flat_terms[np.repeat(value_starts[value_codes[valued]], counts) + offsets_in_value])
+
+    occurrence_rows = np.concatenate(row_parts) if row_parts else np.empty(0, dtype=np.int64)
+    occurrence_terms = np.concatenate(term_parts) if term_parts else np.empty(0, dtype=np.int64)
+    stride = max(len(frame), 1)
+    pairs, frequencies = np.unique(occurrence_terms * stride + occurrence_rows, return_counts=True)
+    pair_terms, pair_rows = np.divmod(pairs, stride)
+    return pair_terms, pair_rows, frequencies
+
+def finish_text_index(words, pair_terms, pair_rows, frequencies, row_count):
+    """
+    The BM25 index from the (term, row, frequency) pairs sorted by term then row. The pairs are kept too, so a
+    reload can re-weight them instead of tokenizing unchanged rows again; terms left without rows are dropped.
+    """
+    doc_lengths = np.bincount(pair_rows, weights=frequencies, minlength=row_count).astype(np.float64)
+    average_length = doc_lengths.mean() if row_count and doc_lengths.any() else 1.0
+    document_frequency = np.bincount(pair_terms, minlength=len(words))
+    used = np.flatnonzero(document_frequency)
+    if len(used) < len(words):
+        renumber = np.full(len(words), -1, dtype=np.int64)
+        renumber[used] = np.arange(len(used))
+        pair_terms = renumber[pair_terms]
+        words = [words[term] for term in used]
+        document_frequency = document_frequency[used]
+
+    idf = np.log((row_count - document_frequency + 0.5) / (document_frequency + 0.5) + 1)
+    norms = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths[pair_rows] / average_length)
+    weights = idf[pair_terms] * frequencies * (BM25_K1 + 1) / (frequencies + norms)
+
+    bounds = np.searchsorted(pair_terms, np.arange(len(words) + 1))
+    return {
+        'postings': {words[t]: (pair_rows[bounds[t]:bounds[t + 1]].astype(np.int32), weights[bounds[t]:bounds[t + 1]]) for t in range(len(words))},
+        'idf': {words[t]: float(idf[t]) for t in range(len(words))},
+        'rows': row_count,
+        'words': words,
+        'pair_terms': pair_terms,
+        'pair_rows': pair_rows,
+        'frequencies': frequencies,
+    }
+
+def bm25_search(index, query):
+    """
+    Returns (rows, BM25 scores, coverage) for the rows containing any of the query's terms, where coverage is the
+    idf-weighted share (0-1) of the query's terms the row contains. Terms missing from the index count as rarest.
+    """
+    terms = set(text_search_terms(query))
+    postings = [(index['postings'][term], index['idf'][term]) for term in terms if term in index['postings']]
+    if not postings:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+    unseen_idf = np.log((index['rows'] + 0.5) / 0.5 + 1)
+    total_idf = sum(index['idf'].get(term, unseen_idf) for term in terms)
+
+    rows, inverse = np.unique(np.concatenate([term_rows for (term_rows, _), _ in postings]), return_inverse=True)
+    bm25 = np.bincount(inverse, weights=np.concatenate([weights for (_, weights), _ in postings]))
+    idf_found = np.bincount(inverse, weights=np.concatenate([np.full(len(term_rows), idf) for (term_rows, _), idf in postings]))
+    return rows, bm25, idf_found / total_idf
+
+def build_tfidf_index(token_sets, size=TFIDF_NGRAM_SIZE):
+    """
+    Builds the TF-IDF index for one search field: a row-normalized sparse matrix (one row per code) of sublinear
+    character n-gram frequencies weighted by smoothed idf, plus the n-gram vocabulary and idf.
+    """
+    if scipy is None:
+        raise KnowledgeBaseError(
+            "Error: SCORING_BACKEND = 'tfidf' needs scipy, which is not installed.",
+            hint="Install scipy (pip install scipy) or set SCORING_BACKEND back to 'token_set'.",
+        )
+    vocabulary = {}
+    rows, columns, weights = [], [], []
+    for position, text in enumerate(token_sets):
+        if not text:
+            continue
+        for gram, count in count_ngrams(text, size).items():
+            rows.append(position)
+            columns.append(vocabulary.setdefault(gram, len(vocabulary)))
+            weights.append(1 + np.log(count))
+    columns = np.array(columns, dtype=np.int64)
+    document_frequency = np.bincount(columns, minlength=len(vocabulary))
+    idf = np.log((1 + len(token_sets)) / (1 + document_frequency)) + 1
+    matrix = scipy.sparse.csr_matrix(
+        (np.array(weights) * idf[columns], (np.array(rows, dtype=np.int64), columns)),
+        shape=(len(token_sets), len(vocabulary)),
+    )
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    matrix = scipy.sparse.diags(1 / np.where(norms > 0, norms, 1)) @ matrix
+    return {'size': size, 'vocabulary': vocabulary, 'idf': idf, 'unseen_idf': np.log(1 + len(token_sets)) + 1, 'matrix': matrix.tocsr()}
+
+def tfidf_similarities(index, text, matrix=None):
+    """Cosine similarity of the text's n-gram vector with every row of the index (or of `matrix`, a subset of them)."""
+    matrix = index['matrix'] if matrix is None else matrix
+    if not text:
+        return np.zeros(matrix.shape[0])
+    columns, weights, norm = [], [], 0.0
+    for gram, count in count_ngrams(text, index['size']).items():
+        column = index['vocabulary'].get(gram)
+        weight = (1 + np.log(count)) * (index['idf'][column] if column is not None else index['unseen_idf'])
+        # N-grams the catalog never uses still count towards the query's length
+        norm += weight * weight
+        if column is not None:
+            columns.append(column)
+            weights.append(weight)
+    if not columns:
+        return np.zeros(matrix.shape[0])
+    vector = scipy.sparse.csr_matrix((np.array(weights) / np.sqrt(norm), columns, [0, len(columns)]), shape=(1, matrix.shape[1]))
+    return (matrix @ vector.T).toarray().ravel()
+
+def _perturb_sample_query(text, rng):
+    """A catalog value as a user might type it: unchanged, with a typo, with some of its words, or truncated."""
+    choice = rng.random()
+    if choice < 0.25:
+        return text
+    if choice < 0.5:
+        i = rng.randrange(len(text))
+        return text[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') + text[i + 1:]
+    if choice < 0.75:
+        words = text.split()
+        return ' '.join(sorted(rng.sample(words, rng.randint(1, len(words)))))
+    return text[:rng.randint(1, len(text))]
+
+def calibrate_tfidf(token_sets_by_field, indexes, seed=0):
+    """
+    Maps TF-IDF similarities onto the token_set_ratio scale: sample queries drawn from the catalog (see
+    _perturb_sample_query) are scored both ways against a sample of each field, and the similarity exceeded as often
+    as token_set reaches MIN_MATCH_SCORE is mapped to MIN_MATCH_SCORE. The mapping is linear on either side of it
+    (0 -> 0, 1 -> 100), so it is strictly increasing and keeps the TF-IDF ranking. Returns its (similarity, score)
+    knots, for np.interp.
+    """
+    rng = random.Random(seed)
+    similarities, scores = [], []
+    for token_sets, index in zip(token_sets_by_field, indexes):
+        populated = [text for text in token_sets if text]
+        if not populated:
+            continue
+        choice_positions = sorted(rng.sample(range(len(token_sets)), min(len(token_sets), TFIDF_CALIBRATION_CHOICES)))
+        choices = [token_sets[i] for i in choice_positions]
+        matrix = index['matrix'][choice_positions]
+        for _ in range(TFIDF_CALIBRATION_QUERIES):
+            sample_query = _perturb_sample_query(rng.choice(populated), rng)
+            similarities.append(tfidf_similarities(index, sample_query, matrix))
+            scores.append(batch_token_set_ratio(sample_query, choices))
+    if not similarities:
+        return np.array([0.0, 1.0]), np.array([0.0, 100.0])
+
+    match_share = np.mean(np.concatenate(scores) >= MIN_MATCH_SCORE)
+    threshold = float(np.quantile(np.concatenate(similarities), 1 - match_share))
+    # np.interp needs strictly increasing knots
+    threshold = min(max(threshold, 1e-6), 1 - 1e-6)
+    return np.array([0.0, threshold, 1.0]), np.array([0.0, float(MIN_MATCH_SCORE), 100.0])
+
+def build_bk_tree(keys):
+    """
+    Builds a BK-tree over the keys under Damerau-Levenshtein distance, as flat plain lists (node i: its key, the
+    positions of the codes sharing it, and {distance: child node}). Every node in the subtree under a node's
+    edge d is at exactly distance d from that node.
+    """
+    tree = {'keys': [], 'positions': [], 'children': []}
+    _bk_tree_insert(tree, {}, enumerate(keys))
+    return tree
+
+def update_bk_tree(tree, previous_positions, previous_count, keys):
+    """
+    The BK-tree over `keys` given the previous version's tree (left untouched): positions of codes carried over
+    (previous_positions >= 0) are renumbered, the other codes are inserted. Nodes left without codes stay in place
+    as routing nodes, so no subtree has to be rebuilt.
+    """
+    new_of_old = invert_positions(previous_positions, previous_count).tolist()
+    tree = {
+        'keys': list(tree['keys']),
+        'positions': [[new_of_old[position] for position in positions if new_of_old[position] >= 0] for positions in tree['positions']],
+        'children': [dict(children) for children in tree['children']],
+    }
+    node_of_key = {key: node for node, key in enumerate(tree['keys'])}
+    _bk_tree_insert(tree, node_of_key, ((position, keys[position]) for position in np.flatnonzero(previous_positions < 0).tolist()))
+    return tree
+
+def _bk_tree_insert(tree, node_of_key, entries):
+    """Adds (position, key) entries to the tree; node_of_key maps the keys already in it to their node."""
+    for position, key in entries:
+        if not key:
+            continue
+        if key in node_of_key:
+            tree['positions'][node_of_key[key]].append(position)
+            continue
+        new_node = len(tree['keys'])
+        node_of_key[key] = new_node
+        tree['keys'].append(key)
+        tree['positions'].append([position])
+        tree['children'].append({})
+        node = 0
+        while new_node:
+            distance = DamerauLevenshtein.distance(key, tree['keys'][node])
+            child = tree['children'][node].get(distance)
+            if child is None:
+                tree['children'][node][distance] = new_node
+                break
+            node = child
+
+def bk_tree_search(tree, key, max_distance):
+    """
+    Returns [(distance, position)] for every key within max_distance of `key`. By the triangle inequality only
+    the edges within max_distance of the current node's distance can lead to matches, so most of the tree is
+    never visited.
+    """
+    found = []
+    stack = [0] if tree['keys'] else []
+    while stack:
+        node = stack.pop()
+        distance = DamerauLevenshtein.distance(key, tree['keys'][node])
+        if distance <= max_distance:
+            found.extend((distance, position) for position in tree['positions'][node])
+        for edge, child in tree['children'][node].items():
+            if distance - max_distance <= edge <= distance + max_distance:
+                stack.append(child)
+    return found
+
+def _starts_all_words(name_words, prefixes):
+    """True if every prefix starts some word of the name."""
+    return all(any(word.startswith(prefix) for word in name_words) for prefix in prefixes)
+
+def build_prefix_index(canonical_codes, processed_names):
+    """
+    Builds the type-ahead index as sorted arrays for binary search: canonical codes, and every word of every
+    setting name, each with the position of its code. All keys starting with a prefix are one contiguous slice.
+    """
+    code_keys = sorted((canonical, position) for position, canonical in enumerate(canonical_codes))
+    name_keys = sorted({(word, position) for position, name in enumerate(processed_names) for word in name.split()})
+    return {
+        'code_keys': [key for key, _ in code_keys],
+        'code_positions': np.array([position for _, position in code_keys], dtype=np.int64),
+        'name_keys': [key for key, _ in name_keys],
+        'name_positions': np.array([position for _, position in name_keys], dtype=np.int64),
+    }
+
+def parse_code_parts(code):
+    """Returns (family, number) of an Access Code ('PR-401' -> ('PR', 401)), or (None, None) for another shape."""
+    match = re.fullmatch(CODE_PARTS_PATTERN, canonicalize_code(code))
+    return (match.group(1), int(match.group(2))) if match else (None, None)
+
+def build_code_number_index(canonical_codes):
+    """
+    Builds the structured code index from the canonical codes: family -> (numbers, code positions), both sorted by
+    number (ties in code order), so a number range within a family is one contiguous slice found by binary search.
+    """
+    families = {}
+    for position, canonical in enumerate(canonical_codes):
+        match = re.fullmatch(CODE_PARTS_PATTERN, canonical)
+        if match:
+            families.setdefault(match.group(1), []).append((int(match.group(2)), position))
+    index = {}
+    for family, entries in families.items():
+        entries.sort()
+        index[family] = (
+            np.array([number for number, _ in entries], dtype=np.int64),
+            np.array([position for _, position in entries], dtype=np.int64),
+        )
+    return index
+
+def parse_structured_query(query):
+    """
+    Recognizes a structured code query: ('range', family, low, high), ('family', family) or
+    ('near', family or None, number); None for anything else. A 'near' query without a family must say "code(s)".
+    """
+    text = unicodedata.normalize('NFKC', str(query)).lower()
+    match = re.search(RANGE_QUERY_PATTERN, text)
+    if match:
+        family, low, keyword_family, dash_family, high = match.groups()
+        other_family = keyword_family or dash_family
+        if other_family is None or other_family == family:
+            low, high = sorted((int(low), int(high)))
+            return ('range', family.upper(), low, high)
+    match = re.search(FAMILY_QUERY_PATTERN, text)
+    if match:
+        return ('family', match.group(1).upper())
+    match = re.search(NEAR_QUERY_PATTERN, text)
+    if match:
+        says_codes, family, number = match.groups()
+        if family is not None or says_codes:
+            return ('near', family.upper() if family is not None else None, int(number))
+    return None
+
+def _blank_mask(column):
+    """True for missing or whitespace-only cells. Categorical columns are tested once per distinct value."""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        categories = column.cat.categories
+        blank_categories = np.asarray(categories.astype(str).str.strip() == '', dtype=bool)
+        codes = column.cat.codes.to_numpy()
+        return (codes < 0) | np.append(blank_categories, True)[codes]
+    return column.isna().to_numpy()
+
+def validate_knowledge_base(frame, code_offsets):
+    """
+    Builds the data-quality report for a compacted knowledge base in one vectorized sweep:
+    duplicate (code, sub code) pairs, codes whose setting name differs between rows (only the first row's
+    name is ever displayed), blank cells in required columns and codes not shaped like ACCESS_CODE_PATTERN.
+    Per-code checks work on the categorical codes and code_offsets, never on Python rows.
+    """
+    started = time.perf_counter()
+    codes = frame['Access Code'].cat.categories
+    counts = np.diff(code_offsets)
+
+    # Excel stores a sub code typed as 00 as the number 0, so digit-only sub codes are compared by value
+    sub_codes = frame['Sub Code'].astype('category')
+    categories = pd.Series(sub_codes.cat.categories.astype(str)).str.strip()
+    keys = pd.factorize(categories.where(~categories.str.fullmatch(r'\d+'), categories.str.lstrip('0')))[0]
+    category_codes = sub_codes.cat.codes.to_numpy()
+    pairs = pd.DataFrame({
+        'code': frame['Access Code'].cat.codes.to_numpy(),
+        'sub_code': np.where(category_codes >= 0, np.append(keys, -1)[category_codes], -1),
+    })
+    duplicated = pairs.duplicated(keep='first').to_numpy()
+    first_duplicates = ~pairs[duplicated].duplicated().to_numpy()
+    duplicate_pairs = frame.loc[duplicated, ['Access Code', 'Sub Code']][first_duplicates]
+
+    # Compare every row's setting name with its code's first row (the one format_single_code_details shows)
+    name_codes = frame['Setting item name'].cat.codes.to_numpy()[:code_offsets[-1]]
+    first_names = np.repeat(name_codes[code_offsets[:-1]], counts)
+    differs = (name_codes != first_names).astype(np.int64)
+    if len(counts):
+        inconsistent = np.add.reduceat(differs, code_offsets[:-1]) * (counts > 0) > 0
+    else:
+        inconsistent = np.zeros(0, dtype=bool)
+
+    malformed = ~pd.Series(codes.astype(str)).str.fullmatch(ACCESS_CODE_PATTERN).to_numpy(dtype=bool)
+    blank_cells = {column: int(_blank_mask(frame[column]).sum()) for column in REQUIRED_COLUMNS}
+
+    return {
+        'rows': len(frame),
+        'codes': len(codes),
+        'duplicate_pairs': len(duplicate_pairs),
+        'duplicate_pair_samples': [f"{code} / {sub_code}" for code, sub_code in duplicate_pairs.head(QUALITY_REPORT_SAMPLES).itertuples(index=False)],
+        'inconsistent_names': int(inconsistent.sum()),
+        'inconsistent_name_samples': list(codes[inconsistent][:QUALITY_REPORT_SAMPLES]),
+        'blank_cells': blank_cells,
+        'malformed_codes': int(malformed.sum()),
+        'malformed_code_samples': list(codes[malformed][:QUALITY_REPORT_SAMPLES]),
+        'seconds': time.perf_counter() - started,
+    }
+
+def count_quality_issues(report):
+    """Total number of problems in a data-quality report."""
+    return report['duplicate_pairs'] + report['inconsistent_names'] + report['malformed_codes'] + sum(report['blank_cells'].values())
+
+class KnowledgeBase:
+    """The parsed knowledge base shared by every session, stamped with the version it was built from."""
+
+    def __init__(self, df, version, load_stats=None, previous=None):
+        """
+        Builds every search structure for the rows in df. When `previous` (the version being replaced) is given,
+        codes whose rows did not change keep their derived strings and index entries, renumbered, and only the
+        changed and added codes are processed, so a reload costs in proportion to what changed.
+        """
+        self.df, self.code_offsets = compact_knowledge_base(df)
+        # Group index, built once: codes in first-seen order, the setting name shown for each (its first row's),
+        # and Access Code -> position in both lists and in code_offsets (row slice)
+        self.access_codes = list(self.df['Access Code'].cat.categories)
+        self.setting_names = self.df['Setting item name'].iloc[self.code_offsets[:-1]].tolist()
+        self.code_positions = {code: i for i, code in enumerate(self.access_codes)}
+        self.code_hashes = hash_codes(self.df, self.code_offsets)
+        # What changed relative to the knowledge base this one replaced (None for a first load), and the previous
+        # position of every code carried over unchanged (-1 for the others; None when nothing can be reused)
+        self.delta = None
+        self.details_cache = {}
+        previous_positions = self._match_unchanged(previous) if previous is not None else None
+        if previous_positions is not None and not (previous_positions >= 0).any():
+            previous_positions = None
+
+        # Both search fields, preprocessed once for the batched scorer
+        self.processed_codes = carry_over(getattr(previous, 'processed_codes', None), previous_positions, preprocess_text, self.access_codes)
+        self.processed_names = carry_over(getattr(previous, 'processed_names', None), previous_positions, preprocess_text, self.setting_names)
+        # ... and as token-set strings (distinct words, sorted), the form token_set_ratio actually compares
+        self.code_token_sets = carry_over(getattr(previous, 'code_token_sets', None), previous_positions, token_set_string, self.processed_codes)
+        self.name_token_sets = carry_over(getattr(previous, 'name_token_sets', None), previous_positions, token_set_string, self.processed_names)
+        # ... and each code's canonical form
+        self.canonical_forms = carry_over(getattr(previous, 'canonical_forms', None), previous_positions, canonicalize_code, self.access_codes)
+        # N-gram inverted indexes over both fields: only the codes they retrieve are scored
+        if previous_positions is not None:
+            self.code_ngram_index = update_ngram_index(previous.code_ngram_index, previous_positions, self.code_token_sets)
+            self.name_ngram_index = update_ngram_index(previous.name_ngram_index, previous_positions, self.name_token_sets)
+        else:
+            ngram_size = NGRAM_SIZE if NGRAM_RECALL_MODE == 'fast' else recall_safe_ngram_size(MIN_MATCH_SCORE, NGRAM_SIZE)
+            self.code_ngram_index = build_ngram_index(self.code_token_sets, ngram_size)
+            self.name_ngram_index = build_ngram_index(self.name_token_sets, ngram_size)
+        # Canonical code -> codes, for the exact-match fast path (several codes can share a canonical form)
+        self.canonical_codes = {}
+        for code, canonical in zip(self.access_codes, self.canonical_forms):
+            self.canonical_codes.setdefault(canonical, []).append(code)
+        # Only with the TF-IDF scoring backend: per-field sparse n-gram matrices and the similarity -> score mapping
+        # (rebuilt on every load: idf and the calibration depend on the whole catalog)
+        self.scoring_backend = SCORING_BACKEND
+        self.tfidf_indexes = self.tfidf_calibration = None
+        if SCORING_BACKEND == 'tfidf':
+            token_sets_by_field = (self.code_token_sets, self.name_token_sets)
+            self.tfidf_indexes = [build_tfidf_index(token_sets) for token_sets in token_sets_by_field]
+            self.tfidf_calibration = calibrate_tfidf(token_sets_by_field, self.tfidf_indexes)
+        # BK-tree over the canonical codes for typo-tolerant lookups
+        if previous_positions is not None:
+            self.code_bk_tree = update_bk_tree(previous.code_bk_tree, previous_positions, len(previous.access_codes), self.canonical_forms)
+        else:
+            self.code_bk_tree = build_bk_tree(self.canonical_forms)
+        # Sorted canonical codes and setting-name words for type-ahead
+        self.prefix_index = build_prefix_index(self.canonical_forms, self.processed_names)
+        # Codes by family and number for range, family and "near" queries
+        self.code_number_index = build_code_number_index(self.canonical_forms)
+        # BM25 index over the meaning/description of every row that belongs to a code
+        if previous_positions is not None:
+            self.text_index = update_text_index(previous.text_index, self.df, self.code_offsets, previous.code_offsets, previous_positions)
+        else:
+            self.text_index = build_text_index(self.df, int(self.code_offsets[-1]))
+        self.quality_report = validate_knowledge_base(self.df, self.code_offsets)
+        # Worker processes scoring this version's shards (see start_shard_pool); never stored in the sidecar
+        self.shard_pool = None
+        self.version = version
+        # How the rows were ingested: reader, rows, seconds and rows/sec (shown in the sidebar)
+        self.load_stats = load_stats or {}
+        self.load_stats['memory_bytes'] = int(self.df.memory_usage(deep=True).sum())
+
+    def _match_unchanged(self, previous):
+        """
+        Fills delta (unchanged/changed/added/removed codes) and details_cache (rendered details of unchanged codes)
+        from the previous version. Returns the previous position of each code whose rows did not change (-1 for
+        the others), or None if the previous version's structures cannot be reused.
+        """
+        previous_hashes = getattr(previous, 'code_hashes', {})
+        previous_details = getattr(previous, 'details_cache', {})
+        previous_code_positions = getattr(previous, 'code_positions', {})
+        previous_positions = np.full(len(self.access_codes), -1, dtype=np.int64)
+        for position, (code, code_hash) in enumerate(self.code_hashes.items()):
+            if previous_hashes.get(code) == code_hash:
+                previous_positions[position] = previous_code_positions.get(code, -1)
+                if code in previous_details:
+                    self.details_cache[code] = previous_details[code]
+
+        unchanged = int((previous_positions >= 0).sum())
+        added = sum(1 for code in self.code_hashes if code not in previous_hashes)
+        self.delta = {
+            'unchanged': unchanged,
+            'changed': len(self.code_hashes) - unchanged - added,
+            'added': added,
+            'removed': sum(1 for code in previous_hashes if code not in self.code_hashes),
+        }
+        reusable = (
+            getattr(previous, 'canonical_forms', None) is not None
+            and getattr(previous, 'scoring_backend', None) == SCORING_BACKEND
+            and 'pair_rows' in getattr(previous, 'text_index', {})
+        )
+        return previous_positions if reusable else None
+
+    def score_fields(self, query, min_score=MIN_MATCH_SCORE, top=None):
+        """
+        Returns (codes, Access Code scores, Setting Item Name scores, stats) for every code.
+        For a token_set field only the codes the n-gram index retrieves are candidates, and only candidates whose
+        score bound can reach min_score (and the top-th best score, when given) are scored; the rest keep 0.
+        A field with another scorer (CODE_SCORER, NAME_SCORER) has every code scored.
+        With the TF-IDF backend every code is scored by one sparse product per field instead.
+        """
+        processed_query = preprocess_text(query)
+        if self.scoring_backend == 'tfidf':
+            return self._score_fields_tfidf(processed_query)
+        scorer_names = get_field_scorers()
+        sharded = self.shard_pool.score_fields(processed_query, scorer_names, min_score, top) if self.shard_pool is not None else None
+        if sharded is not None:
+            (code_scores, name_scores), stats = sharded
+        else:
+            (code_scores, name_scores), stats = score_catalog_fields(
+                processed_query, scorer_names, (self.code_token_sets, self.name_token_sets), (self.code_ngram_index, self.name_ngram_index),
+                (self.processed_codes, self.processed_names), min_score, top,
+            )
+        return self.access_codes, code_scores, name_scores, stats
+
+    def start_shard_pool(self):
+        """Starts the shard workers scoring this version, if the catalog is large enough to need them (see SEARCH_SHARDS)."""
+        if (
+            self.shard_pool is None
+            and self.scoring_backend == 'token_set'
+            and SEARCH_SHARDS > 0
+            and len(self.access_codes) >= SHARDED_SEARCH_MIN_CODES
+        ):
+            self.shard_pool = ShardPool(self, SEARCH_SHARDS)
+            logger.info("Started %d shard workers for %d codes", SEARCH_SHARDS, len(self.access_codes))
+
+    def stop_shard_pool(self):
+        """Stops the shard workers once this version is no longer served (queries still running finish first)."""
+        if self.shard_pool is not None:
+            self.shard_pool.close()
+
+    def _score_fields_tfidf(self, processed_query):
+        """score_fields for the TF-IDF backend: calibrated similarities of every code, nothing pruned."""
+        query_token_set = token_set_string(processed_query)
+        knots, knot_scores = self.tfidf_calibration
+        code_scores, name_scores = (
+            np.rint(np.interp(tfidf_similarities(index, query_token_set), knots, knot_scores)).astype(np.int64)
+            for index in self.tfidf_indexes
+        )
+        count = 2 * len(self.access_codes)
+        return self.access_codes, code_scores, name_scores, {'fields': count, 'candidates': count, 'scored': count, 'pruned': 0}
+
+    def text_matches(self, query):
+        """
+        Returns (text score per code, {code position: matched row}) from the BM25 index: each code scores its best
+        row's coverage of the query (times TEXT_SEARCH_WEIGHT), and BM25 picks that row among equally covered ones.
+        """
+        scores = np.zeros(len(self.access_codes), dtype=np.int64)
+        rows, bm25, coverage = bm25_search(self.text_index, query)
+        if not len(rows):
+            return scores, {}
+        positions = np.searchsorted(self.code_offsets, rows, side='right') - 1
+        row_scores = np.rint(100 * TEXT_SEARCH_WEIGHT * coverage).astype(np.int64)
+        order = np.lexsort((-bm25, -row_scores, positions))
+        first = order[np.concatenate([[True], positions[order][1:] != positions[order][:-1]])]
+        scores[positions[first]] = row_scores[first]
+        return scores, dict(zip(positions[first].tolist(), rows[first].tolist()))
+
+    def sub_code_at(self, row):
+        """Returns the Sub Code of a row (as found by text_matches)."""
+        return self.df['Sub Code'].iloc[row]
+
+    def typo_matches(self, query):
+        """
+        Returns the typo score per code: codes whose canonical form is within TYPO_MAX_DISTANCE edits of the
+        query's score 100 * (1 - edits / length of the longer of the two), the rest 0. Short queries match nothing
+        this way.
+        """
+        scores = np.zeros(len(self.access_codes), dtype=np.int64)
+        canonical = canonicalize_code(query)
+        if len(canonical) >= TYPO_MIN_LENGTH:
+            for distance, position in bk_tree_search(self.code_bk_tree, canonical, TYPO_MAX_DISTANCE):
+                key_length = max(len(canonical), len(self.canonical_forms[position]))
+                scores[position] = max(scores[position], round(100 * (1 - distance / key_length)))
+        return scores
+
+    def complete(self, text, limit=AUTOCOMPLETE_LIMIT):
+        """
+        Returns up to `limit` codes completing what has been typed so far: codes whose canonical form starts with
+        it (in code order), then codes with a setting-name word starting with its last word (and containing
+        words starting with its other words). Each lookup is a binary search plus at most AUTOCOMPLETE_SCAN_LIMIT steps.
+        """
+        index = self.prefix_index
+        positions = []
+        canonical = canonicalize_code(text)
+        if canonical:
+            keys = index['code_keys']
+            start = bisect.bisect_left(keys, canonical)
+            for i in range(start, min(start + limit, len(keys))):
+                if not keys[i].startswith(canonical):
+                    break
+                positions.append(int(index['code_positions'][i]))
+
+        words = preprocess_text(text).split()
+        if words and len(positions) < limit:
+            *complete_words, prefix = words
+            keys = index['name_keys']
+            start = bisect.bisect_left(keys, prefix)
+            for i in range(start, min(start + AUTOCOMPLETE_SCAN_LIMIT, len(keys))):
+                if len(positions) >= limit or not keys[i].startswith(prefix):
+                    break
+                position = int(index['name_positions'][i])
+                if position not in positions and _starts_all_words(self.processed_names[position].split(), complete_words):
+                    positions.append(position)
+        return [self.access_codes[position] for position in positions]
+
+    def codes_in_range(self, family, low=None, high=None):
+        """Returns the codes of a family whose number is within [low, high] (either end open if None), by number."""
+        numbers, positions = self.code_number_index.get(family, (np.zeros(0, dtype=np.int64),) * 2)
+        start = 0 if low is None else int(np.searchsorted(numbers, low, side='left'))
+        end = len(numbers) if high is None else int(np.searchsorted(numbers, high, side='right'))
+        return [self.access_codes[position] for position in positions[start:end]]
+
+    def codes_near(self, number, family=None, count=NEAR_CODES_COUNT):
+        """
+        Returns the `count` codes numerically closest to `number` (within one family, or across all), closest first
+        (ties by family, number and code order). Only the `count` codes either side of the number in each family
+        can qualify, so each family costs one binary search.
+        """
+        families = [family] if family is not None else sorted(self.code_number_index)
+        entries = []
+        for name in families:
+            numbers, positions = self.code_number_index.get(name, (np.zeros(0, dtype=np.int64),) * 2)
+            split = int(np.searchsorted(numbers, number))
+            for i in range(max(split - count, 0), min(split + count, len(numbers))):
+                entries.append((abs(int(numbers[i]) - number), name, int(numbers[i]), int(positions[i])))
+        return [self.access_codes[position] for *_, position in heapq.nsmallest(count, entries)]
+
+    def render_text_match(self, access_code, row):
+        """Returns the details markdown for a code found by its text, pointing out the row that matched."""
+        return format_single_code_details(access_code, self.rows_for(access_code), self.setting_name_for(access_code), self.df.iloc[row])
+
+    def cache_key(self, query):
+        """
+        Queries with equal keys get the same answer: their canonical code form, their scored form and their
+        structured reading (which depends on punctuation the other two drop) agree.
+        """
+        return canonicalize_code(query), preprocess_text(query), parse_structured_query(query)
+
+    def exact_matches(self, query):
+        """Returns the codes whose canonical form equals the query's (usually zero or one) with a hash lookup."""
+        canonical = canonicalize_code(query)
+        return list(self.canonical_codes.get(canonical, ())) if canonical else []
+
+    def setting_name_for(self, access_code):
+        """Returns the setting name displayed for a code, or None for an unknown code."""
+        position = self.code_positions.get(access_code)
+        return None if position is None else self.setting_names[position]
+
+    def rows_for(self, access_code):
+        """Returns the rows of one Access Code as a (read-only) slice, or an empty frame for an unknown code."""
+        position = self.code_positions.get(access_code)
+        if position is None:
+            return self.df.iloc[0:0]
+        return self.df.iloc[self.code_offsets[position]:self.code_offsets[position + 1]]
+
+    def render_details(self, access_code):
+        """Returns the details markdown for a code (rendered once per version of its rows), or None if unknown."""
+        details = self.details_cache.get(access_code)
+        if details is None:
+            matched_df = self.rows_for(access_code)
+            if matched_df.empty:
+                return None
+            details = format_single_code_details(access_code, matched_df, self.setting_name_for(access_code))
+            self.details_cache[access_code] = details
+        return details
+
+    def to_snapshot(self):
+        """Returns the plain-data state stored in the sidecar (no references to classes defined here)."""
+        state = dict(self.__dict__)
+        state['shard_pool'] = None
+        return state
+
+    @classmethod
+    def from_snapshot(cls, state):
+        """Rebuilds a KnowledgeBase from a sidecar snapshot without re-running any build step."""
+        knowledge_base = cls.__new__(cls)
+        knowledge_base.__dict__.update(state)
+        return knowledge_base
+
+
+def get_file_signature(file_path):
+    """
+    Returns a cheap signature of every (mtime, size) behind the knowledge base source, used to detect changes.
+    For a directory or glob, adding or removing a file changes the signature too.
+    """
+    signature = []
+    for path in resolve_source_files(file_path):
+        try:
+            stat = os.stat(path)
+        except OSError:
             return None
-        return df
+        signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature) or None
+
+def get_file_hash(file_path):
+    """Returns the SHA-256 of the source's file names and contents, used to key the sidecar snapshot."""
+    digest = hashlib.sha256()
+    for path in resolve_source_files(file_path):
+        digest.update(os.path.basename(path).encode('utf-8'))
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def get_sidecar_path(file_path, suffix=SIDECAR_SUFFIX):
+    """Returns where a derived artifact for a source lives: next to a file, or inside/next to a directory/glob."""
+    if os.path.isdir(file_path):
+        return os.path.join(file_path, 'knowledge_base' + suffix)
+    if any(char in file_path for char in '*?['):
+        pattern_id = hashlib.sha1(file_path.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(os.path.dirname(file_path) or '.', f"knowledge_base-{pattern_id}{suffix}")
+    return file_path + suffix
+
+def get_build_settings():
+    """Configuration the stored KnowledgeBase structures depend on; a snapshot built under other settings is rebuilt."""
+    return {
+        'min_match_score': MIN_MATCH_SCORE,
+        'ngram_recall_mode': NGRAM_RECALL_MODE,
+        'ngram_size': NGRAM_SIZE,
+        'text_search_columns': TEXT_SEARCH_COLUMNS,
+        'bm25': (BM25_K1, BM25_B),
+        'scoring_backend': SCORING_BACKEND,
+        'tfidf': (TFIDF_NGRAM_SIZE, TFIDF_CALIBRATION_QUERIES, TFIDF_CALIBRATION_CHOICES),
+    }
+
+def _encode_snapshot(value, arrays):
+    """
+    Returns `value` as JSON-compatible data for the sidecar. Arrays are appended to `arrays` (one flat buffer per
+    dtype) and replaced by a reference; tuples, dicts with non-string keys and sparse matrices become one-key
+    {'!tag': ...} objects that _decode_snapshot_object turns back. Anything else is refused, so loading a sidecar
+    never reconstructs arbitrary objects.
+    """
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, list):
+        if all(type(item) is str or type(item) is int for item in value):
+            # Most of the state (codes, names, token sets, BK-tree positions) is lists of strings or ints
+            return value
+        return [_encode_snapshot(item, arrays) for item in value]
+    if isinstance(value, tuple):
+        return {'!tuple': [_encode_snapshot(item, arrays) for item in value]}
+    if isinstance(value, dict):
+        if all(isinstance(key, str) and not key.startswith('!') for key in value):
+            return {key: _encode_snapshot(item, arrays) for key, item in value.items()}
+        if all(type(key) is int and type(item) is int for key, item in value.items()):
+            # BK-tree edges
+            return {'!dict': list(value.items())}
+        return {'!dict': [[_encode_snapshot(key, arrays), _encode_snapshot(item, arrays)] for key, item in value.items()]}
+    if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        chunks, size = arrays.setdefault(value.dtype.str, ([], [0]))
+        chunks.append(value.ravel())
+        size[0] += value.size
+        return {'!array': [value.dtype.str, size[0] - value.size, list(value.shape)]}
+    if isinstance(value, np.generic):
+        return value.item()
+    if scipy is not None and scipy.sparse.issparse(value):
+        matrix = value.tocsr()
+        return {'!csr': [_encode_snapshot(part, arrays) for part in (matrix.data, matrix.indices, matrix.indptr)] + [list(matrix.shape)]}
+    raise TypeError(f"{type(value).__name__} cannot be stored in the sidecar")
+
+def _decode_snapshot_object(obj, buffers):
+    """json object_hook reversing _encode_snapshot; array references become views into `buffers` (by dtype)."""
+    if len(obj) != 1:
+        return obj
+    (tag, value), = obj.items()
+    if tag == '!tuple':
+        return tuple(value)
+    if tag == '!dict':
+        return {key: item for key, item in value}
+    if tag == '!array':
+        dtype, offset, shape = value
+        return buffers[dtype][offset:offset + math.prod(shape)].reshape(shape)
+    if tag == '!csr':
+        data, indices, indptr, shape = value
+        return scipy.sparse.csr_matrix((data, indices, indptr), shape=tuple(shape))
+    return obj
+
+def load_sidecar(sidecar_path, source_hash):
+    """
+    Returns the KnowledgeBase stored in the sidecar, or None if it is missing, stale or unreadable.
+    The sidecar is an .npz archive read with allow_pickle=False: JSON for the header and the structures, one flat
+    buffer per array dtype and the frame as Parquet, so a planted or corrupt file can at worst fail to load.
+    """
+    try:
+        with np.load(sidecar_path, allow_pickle=False) as archive:
+            header = json.loads(archive['header'].tobytes(), object_hook=lambda obj: _decode_snapshot_object(obj, {}))
+            if not isinstance(header, dict) or header.get('format') != SIDECAR_FORMAT_VERSION:
+                return None
+            if header.get('source_hash') != source_hash or header.get('settings') != get_build_settings():
+                return None
+            buffers = {dtype: archive[f'array{number}'] for number, dtype in enumerate(header['dtypes'])}
+            state = json.loads(archive['state'].tobytes(), object_hook=lambda obj: _decode_snapshot_object(obj, buffers))
+            state['df'] = pd.read_parquet(io.BytesIO(archive['frame'].tobytes()))
     except FileNotFoundError:
-        st.error(f"Error: The file '{file_path}' was not found. Please ensure it is an Excel file (.xlsx or .xls) and correctly named.")
         return None
-    except Exception as e:
-        st.error(f"An error occurred while loading the Excel file: {e}")
-        st.info("Ensure the file structure is correct and necessary libraries (pandas, openpyxl) and tabulate are installed.")
+    except Exception:
+        # A corrupt or incompatible snapshot is simply rebuilt from the source file
+        return None
+    return KnowledgeBase.from_snapshot(state)
+
+def save_sidecar(sidecar_path, source_hash, knowledge_base):
+    """Writes the sidecar atomically; failures (e.g. a read-only directory) only cost the next cold start."""
+    if pyarrow is None:
+        # The frame is stored as Parquet
+        return
+    state = knowledge_base.to_snapshot()
+    frame = io.BytesIO()
+    arrays = {}
+    try:
+        state.pop('df').to_parquet(frame)
+        encoded_state = json.dumps(_encode_snapshot(state, arrays)).encode('utf-8')
+    except (ValueError, TypeError):
+        # e.g. a column mixing numbers and text, which Parquet cannot store: only costs the next cold start
+        logger.warning("Knowledge base snapshot not written to '%s'", sidecar_path, exc_info=True)
+        return
+    header = {
+        'format': SIDECAR_FORMAT_VERSION,
+        'source_hash': source_hash,
+        'settings': get_build_settings(),
+        'dtypes': list(arrays),
+    }
+    entries = {
+        'header': np.frombuffer(json.dumps(_encode_snapshot(header, {})).encode('utf-8'), dtype=np.uint8),
+        'state': np.frombuffer(encoded_state, dtype=np.uint8),
+        'frame': np.frombuffer(frame.getvalue(), dtype=np.uint8),
+    }
+    for number, (dtype, (chunks, _)) in enumerate(arrays.items()):
+        entries[f'array{number}'] = np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+    temp_path = f"{sidecar_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **entries)
+        os.replace(temp_path, sidecar_path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def make_load_stats(reader, rows, seconds, files=1):
+    """Returns the load statistics recorded on a KnowledgeBase."""
+    return {
+        'reader': reader,
+        'files': files,
+        'rows': rows,
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds > 0 else float(rows),
+    }
+
+def build_knowledge_base(file_path, previous=None):
+    """
+    Returns the KnowledgeBase for the file, reusing the sidecar snapshot when its content hash matches.
+    Only a changed (or first-seen) file goes through the Excel parser. Raises KnowledgeBaseError.
+    When reloading, `previous` is the version being replaced: per-code work for unchanged codes is reused.
+    """
+    # Report a misconfigured scorer on load rather than on the first query
+    get_field_scorers()
+    if STORAGE_BACKEND == 'sqlite':
+        return build_sqlite_knowledge_base(file_path)
+
+    try:
+        source_hash = get_file_hash(file_path)
+    except OSError:
+        # Let load_data report the missing/unreadable file with its usual message
+        source_hash = None
+
+    sidecar_path = get_sidecar_path(file_path)
+    if source_hash is not None:
+        started = time.perf_counter()
+        knowledge_base = load_sidecar(sidecar_path, source_hash)
+        if knowledge_base is not None:
+            previous_stats = knowledge_base.load_stats
+            knowledge_base.load_stats = make_load_stats('snapshot', len(knowledge_base.df), time.perf_counter() - started, previous_stats.get('files', 1))
+            knowledge_base.load_stats['memory_bytes'] = previous_stats['memory_bytes']
+            return knowledge_base
+
+    started = time.perf_counter()
+    df = load_data(file_path)
+    files = resolve_source_files(file_path)
+    reader = ', '.join(sorted({describe_reader(path) for path in files}))
+    load_stats = make_load_stats(reader, len(df), time.perf_counter() - started, len(files))
+    logger.info("Loaded %d rows from '%s' with the %s reader (%.0f rows/sec)", len(df), file_path, reader, load_stats['rows_per_second'])
+
+    knowledge_base = KnowledgeBase(df, source_hash, load_stats, previous)
+    if knowledge_base.delta:
+        logger.info("Knowledge base delta for '%s': %s", file_path, knowledge_base.delta)
+    if source_hash is not None:
+        save_sidecar(sidecar_path, source_hash, knowledge_base)
+    return knowledge_base
+
+# --- Sharded Search ---
+
+def slice_ngram_index(index, start, end):
+    """The n-gram index of codes [start, end) only, renumbered from 0 (for a shard worker)."""
+    new_of_old = np.full(len(index['lengths']), -1, dtype=np.int64)
+    new_of_old[start:end] = np.arange(end - start)
+    return {
+        'size': index['size'],
+        'mode': index['mode'],
+        'min_score': index['min_score'],
+        'grams': remap_postings(index['grams'], new_of_old),
+        'tokens': remap_postings(index['tokens'], new_of_old),
+        'lengths': index['lengths'][start:end],
+    }
+
+def _shard_worker(connection, shard):
+    """
+    Body of a shard worker process: holds the token sets, processed values and n-gram indexes of codes
+    [start, end) (sent by ShardPool, sliced from the knowledge base's own indexes), then answers
+    (request id, query, scorer names, min_score, top) requests in order with the request id and the positions and
+    field scores of every shard code that scored above 0, until it receives None.
+    """
+    start = shard['start']
+    token_sets_by_field, values_by_field, ngram_indexes = shard['token_sets'], shard['values'], shard['ngram_indexes']
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        request_id, processed_query, scorer_names, min_score, top = request
+        field_scores, stats = score_catalog_fields(processed_query, scorer_names, token_sets_by_field, ngram_indexes, values_by_field, min_score, top)
+        scored = np.flatnonzero(np.maximum.reduce(field_scores))
+        connection.send((request_id, scored + start, [scores[scored] for scores in field_scores], stats))
+    connection.close()
+
+class ShardPool:
+    """
+    Persistent worker processes, one per shard (a contiguous range of code positions) of a KnowledgeBase.
+    A query is sent to every shard and the shards' scores are merged back into whole-catalog arrays. Each shard
+    prunes against its own best score, which is never above the catalog's, so every code that can share the best
+    (or top-k) score is still scored exactly: answers and ambiguity are the same as scoring in this process.
+    Queries from several sessions are in flight at once: requests carry an id, and one reader thread per shard
+    hands every reply to the query waiting for it.
+    """
+
+    def __init__(self, knowledge_base, shard_count):
+        # Spawned, not forked: pools are started from the watcher thread too, and a child forked from a threaded
+        # process can inherit a lock another thread was holding. Each worker is sent only its shard's data,
+        # including its slice of the n-gram indexes, so a delta reload is not undone by rebuilding them.
+        context = multiprocessing.get_context('spawn')
+        self.code_count = len(knowledge_base.access_codes)
+        self.closed = False
+        # Guards closed and the request pipes: held to send a request, not while it is scored
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count()
+        # (request id, shard number) -> Future of that shard's reply, and the shards whose worker is gone. A separate
+        # lock, so a reader thread never waits on a sender blocked by a full pipe
+        self._pending_lock = threading.Lock()
+        self._pending = {}
+        self._dead_shards = set()
+        self._shards = []
+        bounds = np.linspace(0, self.code_count, shard_count + 1).astype(np.int64)
+        for shard_number, (start, end) in enumerate(zip(bounds[:-1].tolist(), bounds[1:].tolist())):
+            shard = {
+                'start': start,
+                'token_sets': (knowledge_base.code_token_sets[start:end], knowledge_base.name_token_sets[start:end]),
+                'values': (knowledge_base.processed_codes[start:end], knowledge_base.processed_names[start:end]),
+                'ngram_indexes': [
+                    slice_ngram_index(index, start, end)
+                    for index in (knowledge_base.code_ngram_index, knowledge_base.name_ngram_index)
+                ],
+            }
+            connection, worker_connection = context.Pipe()
+            process = context.Process(
+                target=spawn_target(_shard_worker), args=(worker_connection, shard),
+                name=f"kb-shard:{start}-{end}", daemon=True,
+            )
+            process.start()
+            worker_connection.close()
+            reader = threading.Thread(
+                target=self._read_replies, args=(shard_number, connection), name=f"kb-shard-reader:{start}-{end}", daemon=True,
+            )
+            reader.start()
+            self._shards.append((connection, process))
+
+    def _read_replies(self, shard_number, connection):
+        """Reader thread of one shard: resolves the Future of every reply; once the worker is gone, fails the rest."""
+        try:
+            while True:
+                request_id, *reply = connection.recv()
+                with self._pending_lock:
+                    future = self._pending.pop((request_id, shard_number), None)
+                if future is not None:
+                    future.set_result(reply)
+        except (OSError, EOFError):
+            pass
+        finally:
+            with self._pending_lock:
+                self._dead_shards.add(shard_number)
+                failed = [key for key in self._pending if key[1] == shard_number]
+                futures = [self._pending.pop(key) for key in failed]
+            for future in futures:
+                future.set_exception(EOFError(f"shard worker {shard_number} exited"))
+            connection.close()
+
+    def score_fields(self, processed_query, scorer_names, min_score, top):
+        """
+        Returns (field score arrays, stats) like score_catalog_fields over the whole catalog, or None once the pool
+        is closed or a worker has failed (the caller then scores in this process).
+        """
+        request_id = next(self._request_ids)
+        futures = [Future() for _ in self._shards]
+        try:
+            with self._lock:
+                if self.closed:
+                    return None
+                with self._pending_lock:
+                    if self._dead_shards:
+                        raise EOFError(f"shard worker {min(self._dead_shards)} exited")
+                    self._pending.update(((request_id, shard_number), future) for shard_number, future in enumerate(futures))
+                for connection, _ in self._shards:
+                    connection.send((request_id, processed_query, scorer_names, min_score, top))
+            replies = [future.result() for future in futures]
+        except (OSError, EOFError) as e:
+            logger.warning("A shard worker failed (%s); scoring in-process from now on", e)
+            self.close()
+            return None
+
+        field_scores = [np.zeros(self.code_count, dtype=np.int64) for _ in scorer_names]
+        stats = {'fields': self.code_count * len(scorer_names), 'candidates': 0, 'scored': 0, 'pruned': 0, 'shards': len(replies)}
+        for positions, shard_scores, shard_stats in replies:
+            for scores, values in zip(field_scores, shard_scores):
+                scores[positions] = values
+            for key in ('candidates', 'scored', 'pruned'):
+                stats[key] += shard_stats[key]
+        return field_scores, stats
+
+    def close(self):
+        """Stops the workers once they have answered the queries already sent to them."""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            for connection, _ in self._shards:
+                try:
+                    connection.send(None)
+                except OSError:
+                    pass
+        for _, process in self._shards:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+# --- SQLite Storage Backend ---
+
+# Columns stored per row by the SQLite backend
+SQLITE_COLUMNS = LOADED_COLUMNS + [SOURCE_COLUMN]
+SQLITE_SCHEMA_VERSION = 5
+
+def _sql_name(column):
+    return '"' + column.replace('"', '""') + '"'
+
+def _fts_match_expression(tokens):
+    """ORs the trigrams of the query tokens into an FTS5 MATCH expression (trigram tokenizer)."""
+    grams = sorted({token[i:i + 3] for token in tokens for i in range(len(token) - 2)})
+    return ' OR '.join('"' + gram.replace('"', '""') + '"' for gram in grams)
+
+def import_to_sqlite(file_path, db_path, source_hash):
+    """
+    Imports every file behind the source into a fresh SQLite database at db_path and returns the row count.
+    Files are inserted one at a time, so at most one file's rows are in memory. The database is written
+    to a temporary path and moved into place, so readers of the previous version are never disturbed.
+    """
+    columns = ', '.join(_sql_name(column) for column in SQLITE_COLUMNS)
+    placeholders = ', '.join('?' for _ in SQLITE_COLUMNS)
+    code, name, meaning, description = (_sql_name(column) for column in ('Access Code', 'Setting item name', 'Meaning of sub code', 'Description of values'))
+    text_columns = [_sql_name(column) for column in TEXT_SEARCH_COLUMNS if column in SQLITE_COLUMNS]
+    text_terms = f"text_terms({', '.join(text_columns)})" if text_columns else "''"
+
+    temp_path = f"{db_path}.{os.getpid()}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    connection = sqlite3.connect(temp_path)
+    row_count = 0
+    try:
+        # Untyped columns keep values as loaded (text, see as_text_columns)
+        connection.create_function('canonicalize_code', 1, canonicalize_code, deterministic=True)
+        connection.create_function('token_set', 1, lambda text: token_set_string(preprocess_text(text)), deterministic=True)
+        connection.create_function('code_family', 1, lambda text: parse_code_parts(text)[0], deterministic=True)
+        connection.create_function('code_number', 1, lambda text: parse_code_parts(text)[1], deterministic=True)
+        connection.create_function('text_terms', -1, lambda *values: ' '.join(term for value in values if value is not None for term in text_search_terms(value)), deterministic=True)
+        connection.execute(f"CREATE TABLE kb_rows ({', '.join(_sql_name(column) for column in SQLITE_COLUMNS)})")
+        for source_file in require_source_files(file_path):
+            for df in read_source_file(source_file):
+                df = df.reindex(columns=SQLITE_COLUMNS).astype(object)
+                df = df.where(df.notna(), None)
+                connection.executemany(f"INSERT INTO kb_rows ({columns}) VALUES ({placeholders})", df.itertuples(index=False, name=None))
+                row_count += len(df)
+
+        connection.executescript(f"""
+            CREATE INDEX kb_rows_code ON kb_rows ({code});
+            -- One row per code in first-seen order; the setting name comes from the code's first row.
+            -- Both search fields are stored as token-set strings too, so queries never re-normalize them,
+            -- and each code's family and number (NULL for other shapes) for structured queries
+            CREATE TABLE kb_codes (code, setting_name, canonical, code_tokens, name_tokens, family, number);
+            INSERT INTO kb_codes (code, setting_name, canonical, code_tokens, name_tokens, family, number)
+                SELECT {code}, {name}, canonicalize_code({code}), token_set({code}), token_set({name}),
+                       code_family({code}), code_number({code}) FROM kb_rows
+                WHERE rowid IN (SELECT MIN(rowid) FROM kb_rows WHERE {code} IS NOT NULL GROUP BY {code})
+                ORDER BY rowid;
+            CREATE INDEX kb_codes_canonical ON kb_codes (canonical);
+            CREATE INDEX kb_codes_family_number ON kb_codes (family, number);
+            CREATE VIRTUAL TABLE kb_codes_fts USING fts5(code, setting_name, content='kb_codes', tokenize='trigram');
+            INSERT INTO kb_codes_fts (kb_codes_fts) VALUES ('rebuild');
+            CREATE VIRTUAL TABLE kb_rows_fts USING fts5({meaning}, {description}, content='kb_rows', tokenize='trigram');
+            INSERT INTO kb_rows_fts (kb_rows_fts) VALUES ('rebuild');
+            -- The BM25 terms (text_search_terms) of every row that belongs to a code, for text_matches;
+            -- kb_terms_vocab gives each term's document count, so idf is computed as in the memory backend
+            CREATE VIRTUAL TABLE kb_terms_fts USING fts5(terms, tokenize="unicode61 tokenchars '_'");
+            INSERT INTO kb_terms_fts (rowid, terms) SELECT rowid, {text_terms} FROM kb_rows WHERE {code} IS NOT NULL;
+            CREATE VIRTUAL TABLE kb_terms_vocab USING fts5vocab(kb_terms_fts, 'row');
+            CREATE TABLE kb_meta (key PRIMARY KEY, value);
+        """)
+        connection.executemany(
+            "INSERT INTO kb_meta (key, value) VALUES (?, ?)",
+            [('schema', SQLITE_SCHEMA_VERSION), ('source_hash', source_hash), ('rows', row_count)],
+        )
+        connection.execute("INSERT INTO kb_meta (key, value) SELECT 'text_rows', count(*) FROM kb_terms_fts")
+        connection.commit()
+    except sqlite3.Error as e:
+        raise KnowledgeBaseError(
+            f"An error occurred while building the SQLite knowledge base: {e}",
+            hint="The SQLite backend needs an SQLite build with the FTS5 trigram tokenizer (3.34 or later).",
+        )
+    finally:
+        connection.close()
+
+    os.replace(temp_path, db_path)
+    return row_count
+
+def read_sqlite_meta(db_path):
+    """Returns the kb_meta table of an existing database as a dict, or {} if it is missing or unreadable."""
+    if not os.path.exists(db_path):
+        return {}
+    try:
+        connection = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            return dict(connection.execute("SELECT key, value FROM kb_meta"))
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return {}
+
+class SqliteKnowledgeBase:
+    """
+    Knowledge base served from an on-disk SQLite database instead of a DataFrame.
+    Trigram FTS5 indexes over the code, setting name, meaning and description pick the candidate codes
+    for a query, and only the rows of the codes that are actually displayed are read back.
+    """
+
+    def __init__(self, db_path, version, load_stats=None):
+        self.db_path = db_path
+        self.version = version
+        self.load_stats = load_stats or {}
+        # sqlite3 connections cannot be shared between threads, and Streamlit runs sessions on several
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+            self._local.connection = connection
+        return connection
+
+    def _query_state(self, query):
+        """
+        Returns (candidates, text hits) for the query, remembered for the last query on this thread: score_fields
+        and text_matches of one query must see the same candidates, in the same order.
+        """
+        state = getattr(self._local, 'query_state', None)
+        if state is None or state[0] != query:
+            text_hits = self.text_hits(query)
+            state = (query, list(self.iter_candidates(query, text_hits)), text_hits)
+            self._local.query_state = state
+        return state[1], state[2]
+
+    def text_hits(self, query):
+        """
+        Returns (row id, candidate, BM25, coverage) for the rows whose BM25 terms include any of the query's, best
+        FTS5 bm25() first (at most SQLITE_MAX_CANDIDATES), where candidate is the row's code as iter_candidates
+        yields it and coverage is computed as in bm25_search, with idf from the kb_terms_vocab document counts.
+        """
+        terms = set(text_search_terms(query))
+        if not terms:
+            return []
+        connection = self._connection()
+        row_count = connection.execute("SELECT value FROM kb_meta WHERE key = 'text_rows'").fetchone()[0]
+        placeholders = ', '.join('?' for _ in terms)
+        document_frequency = dict(connection.execute(f"SELECT term, doc FROM kb_terms_vocab WHERE term IN ({placeholders})", tuple(terms)))
+        if not document_frequency:
+            return []
+        idf = {term: np.log((row_count - document_frequency.get(term, 0) + 0.5) / (document_frequency.get(term, 0) + 0.5) + 1) for term in terms}
+        total_idf = sum(idf.values())
+        rows = connection.execute(
+            f"SELECT f.rowid, c.code, c.setting_name, c.code_tokens, c.name_tokens, f.terms, bm25(kb_terms_fts) FROM kb_terms_fts f "
+            f"JOIN kb_rows r ON r.rowid = f.rowid JOIN kb_codes c ON c.code = r.{_sql_name('Access Code')} "
+            "WHERE kb_terms_fts MATCH ? ORDER BY f.rank LIMIT ?",
+            (' OR '.join(f'"{term}"' for term in sorted(document_frequency)), SQLITE_MAX_CANDIDATES),
+        )
+        return [
+            (rowid, (code, setting_name, code_tokens, name_tokens), -bm25, sum(idf[term] for term in terms.intersection(row_terms.split())) / total_idf)
+            for rowid, code, setting_name, code_tokens, name_tokens, row_terms, bm25 in rows
+        ]
+
+    def iter_candidates(self, query, text_hits=()):
+        """
+        Yields (access_code, setting_name, code token set, name token set) for the codes the FTS indexes retrieve,
+        then for the codes of the text hits (see text_hits) not retrieved yet.
+        """
+        connection = self._connection()
+        tokens = re.findall(r'\w+', query.lower())
+        seen = set()
+
+        def emit(rows):
+            for row in rows:
+                if row[0] not in seen:
+                    seen.add(row[0])
+                    yield row
+
+        match_expression = _fts_match_expression(tokens)
+        if match_expression:
+            yield from emit(connection.execute(
+                "SELECT c.code, c.setting_name, c.code_tokens, c.name_tokens FROM kb_codes_fts f JOIN kb_codes c ON c.rowid = f.rowid "
+                "WHERE kb_codes_fts MATCH ? ORDER BY f.rank LIMIT ?",
+                (match_expression, SQLITE_MAX_CANDIDATES),
+            ))
+            code_column = _sql_name('Access Code')
+            yield from emit(connection.execute(
+                f"SELECT c.code, c.setting_name, c.code_tokens, c.name_tokens FROM kb_rows_fts f JOIN kb_rows r ON r.rowid = f.rowid "
+                f"JOIN kb_codes c ON c.code = r.{code_column} "
+                "WHERE kb_rows_fts MATCH ? ORDER BY f.rank LIMIT ?",
+                (match_expression, SQLITE_MAX_CANDIDATES),
+            ))
+
+        # Tokens shorter than a trigram (e.g. 'PR' in 'PR 4') can only be found by a substring scan of the codes
+        for token in tokens:
+            if len(token) < 3:
+                pattern = f"%{token}%"
+                yield from emit(connection.execute(
+                    "SELECT code, setting_name, code_tokens, name_tokens FROM kb_codes WHERE lower(code) LIKE ? OR lower(setting_name) LIKE ? "
+                    "ORDER BY rowid LIMIT ?",
+                    (pattern, pattern, SQLITE_MAX_CANDIDATES),
+                ))
+        yield from emit(candidate for _, candidate, _, _ in text_hits)
+
+    def score_fields(self, query, min_score=MIN_MATCH_SCORE, top=None):
+        """
+        Returns (codes, Access Code scores, Setting Item Name scores, stats) for the candidates the FTS indexes
+        retrieve, scored by each field's scorer and pruned by score bounds (token_set) like the memory backend.
+        """
+        candidates, _ = self._query_state(query)
+        codes = [code for code, _, _, _ in candidates]
+        processed_query = preprocess_text(query)
+        query_tokens = set(processed_query.split())
+        scorer_names = get_field_scorers()
+        fields = []
+        for token_sets in ([code_tokens for _, _, code_tokens, _ in candidates], [name_tokens for _, _, _, name_tokens in candidates]):
+            fields.append((
+                token_sets,
+                np.arange(len(token_sets)),
+                np.array([len(text) for text in token_sets], dtype=np.int64),
+                np.array([not query_tokens.isdisjoint(text.split()) for text in token_sets], dtype=bool),
+            ))
+        values = [
+            [preprocess_text(value) for value in field_values] if scorer_name != 'token_set' else None
+            for scorer_name, field_values in zip(scorer_names, ([code for code, _, _, _ in candidates], [name for _, name, _, _ in candidates]))
+        ]
+        (code_scores, name_scores), stats = score_fields_with_scorers(processed_query, scorer_names, values, fields, len(codes), min_score, top)
+        return codes, code_scores, name_scores, stats
+
+    def complete(self, text, limit=AUTOCOMPLETE_LIMIT):
+        """
+        Like KnowledgeBase.complete: a range scan of the kb_codes_canonical index for codes, then setting names
+        with a word starting with the last word typed (a bounded LIKE scan).
+        """
+        connection = self._connection()
+        codes = []
+        canonical = canonicalize_code(text)
+        if canonical:
+            rows = connection.execute(
+                "SELECT code FROM kb_codes WHERE canonical >= ? AND canonical < ? ORDER BY canonical, rowid LIMIT ?",
+                (canonical, canonical + '\uffff', limit),
+            )
+            codes = [code for code, in rows]
+
+        words = preprocess_text(text).split()
+        if words and len(codes) < limit:
+            rows = connection.execute(
+                "SELECT code, setting_name FROM (SELECT code, setting_name FROM kb_codes WHERE lower(setting_name) LIKE ? LIMIT ?)",
+                (f"%{words[-1]}%", AUTOCOMPLETE_SCAN_LIMIT),
+            )
+            for code, setting_name in rows:
+                name_words = preprocess_text(setting_name).split()
+                if (
+                    code not in codes
+                    and _starts_all_words(name_words, words)
+                ):
+                    codes.append(code)
+                    if len(codes) >= limit:
+                        break
+        return codes
+
+    def codes_in_range(self, family, low=None, high=None):
+        """Like KnowledgeBase.codes_in_range, through the kb_codes_family_number index."""
+        rows = self._connection().execute(
+            "SELECT code FROM kb_codes WHERE family = ? AND number >= coalesce(?, number) AND number <= coalesce(?, number) "
+            "ORDER BY number, rowid",
+            (family, low, high),
+        )
+        return [code for code, in rows]
+
+    def codes_near(self, number, family=None, count=NEAR_CODES_COUNT):
+        """
+        Like KnowledgeBase.codes_near (same order): per family, the `count` codes either side of the number are two
+        range reads of the kb_codes_family_number index, and the families themselves are stepped through it.
+        """
+        connection = self._connection()
+        if family is not None:
+            families = [family]
+        else:
+            families = []
+            row = connection.execute("SELECT min(family) FROM kb_codes").fetchone()
+            while row[0] is not None:
+                families.append(row[0])
+                row = connection.execute("SELECT min(family) FROM kb_codes WHERE family > ?", (row[0],)).fetchone()
+        entries = []
+        for name in families:
+            below = connection.execute(
+                "SELECT number, rowid, code FROM kb_codes WHERE family = ? AND number < ? ORDER BY number DESC, rowid DESC LIMIT ?",
+                (name, number, count),
+            )
+            above = connection.execute(
+                "SELECT number, rowid, code FROM kb_codes WHERE family = ? AND number >= ? ORDER BY number, rowid LIMIT ?",
+                (name, number, count),
+            )
+            entries.extend((abs(code_number - number), name, code_number, rowid, code) for code_number, rowid, code in [*below, *above])
+        return [code for *_, code in heapq.nsmallest(count, entries)]
+
+    def start_shard_pool(self):
+        """No shard workers here: SQLite already scores only the candidates its indexes retrieve."""
+
+    def stop_shard_pool(self):
+        """No shard workers to stop."""
+
+    def typo_matches(self, query):
+        """No typo-tolerant lookups here: the BK-tree would need every code in memory."""
         return None
 
-def format_single_code_details(access_code, matched_df):
-    """Formats the detailed output for a single, known Access Code."""
+    def text_matches(self, query):
+        """
+        Like KnowledgeBase.text_matches, for the candidates score_fields returns: each code scores its best text hit's
+        coverage of the query (times TEXT_SEARCH_WEIGHT), and bm25() picks that row among equally covered ones.
+        """
+        candidates, text_hits = self._query_state(query)
+        positions = {code: i for i, (code, _, _, _) in enumerate(candidates)}
+        scores = np.zeros(len(candidates), dtype=np.int64)
+        rows = {}
+        for rowid, (code, _, _, _), _, coverage in text_hits:
+            position = positions[code]
+            score = round(100 * TEXT_SEARCH_WEIGHT * coverage)
+            if score > scores[position]:
+                scores[position] = score
+                rows[position] = rowid
+        return scores, rows
+
+    def sub_code_at(self, row):
+        """Returns the Sub Code of a kb_rows row (as found by text_matches)."""
+        return self._connection().execute(f"SELECT {_sql_name('Sub Code')} FROM kb_rows WHERE rowid = ?", (row,)).fetchone()[0]
+
+    def render_text_match(self, access_code, row):
+        """Returns the details markdown for a code found by its text, pointing out the kb_rows row that matched."""
+        columns = ', '.join(_sql_name(column) for column in SQLITE_COLUMNS)
+        matched_row = pd.read_sql_query(f"SELECT {columns} FROM kb_rows WHERE rowid = ?", self._connection(), params=(row,))
+        return format_single_code_details(access_code, self.rows_for(access_code), matched_row=matched_row.iloc[0])
+
+    def cache_key(self, query):
+        """Like KnowledgeBase.cache_key, plus the words the FTS candidate retrieval sees."""
+        return canonicalize_code(query), preprocess_text(query), parse_structured_query(query), tuple(re.findall(r'\w+', query.lower()))
+
+    def exact_matches(self, query):
+        """Returns the codes whose canonical form equals the query's, through the kb_codes_canonical index."""
+        canonical = canonicalize_code(query)
+        if not canonical:
+            return []
+        rows = self._connection().execute("SELECT code FROM kb_codes WHERE canonical = ? ORDER BY rowid", (canonical,))
+        return [code for code, in rows]
+
+    def setting_name_for(self, access_code):
+        """Returns the setting name displayed for a code, or None for an unknown code."""
+        row = self._connection().execute("SELECT setting_name FROM kb_codes WHERE code = ?", (access_code,)).fetchone()
+        return None if row is None else row[0]
+
+    def rows_for(self, access_code):
+        """Reads the rows of one Access Code back as a DataFrame, in file order."""
+        columns = ', '.join(_sql_name(column) for column in SQLITE_COLUMNS)
+        return pd.read_sql_query(
+            f"SELECT {columns} FROM kb_rows WHERE {_sql_name('Access Code')} = ? ORDER BY rowid",
+            self._connection(),
+            params=(access_code,),
+        )
+
+    def render_details(self, access_code):
+        """Returns the details markdown for a code, or None if unknown."""
+        matched_df = self.rows_for(access_code)
+        if matched_df.empty:
+            return None
+        return format_single_code_details(access_code, matched_df)
+
+def build_sqlite_knowledge_base(file_path):
+    """Returns a SqliteKnowledgeBase for the source, re-importing only when the source's content hash changed."""
+    try:
+        source_hash = get_file_hash(file_path)
+    except OSError:
+        # Let the import report the missing/unreadable file with its usual message
+        source_hash = None
+
+    db_path = get_sidecar_path(file_path, SQLITE_DB_SUFFIX)
+    files = len(resolve_source_files(file_path))
+    started = time.perf_counter()
+    meta = read_sqlite_meta(db_path)
+    if source_hash is not None and meta.get('schema') == SQLITE_SCHEMA_VERSION and meta.get('source_hash') == source_hash:
+        load_stats = make_load_stats('sqlite (existing database)', meta['rows'], time.perf_counter() - started, files)
+        return SqliteKnowledgeBase(db_path, source_hash, load_stats)
+
+    row_count = import_to_sqlite(file_path, db_path, source_hash)
+    load_stats = make_load_stats('sqlite import', row_count, time.perf_counter() - started, files)
+    logger.info("Imported %d rows from '%s' into '%s' (%.0f rows/sec)", row_count, file_path, db_path, load_stats['rows_per_second'])
+    return SqliteKnowledgeBase(db_path, source_hash, load_stats)
+
+class KnowledgeBaseWatcher:
+    """
+    Holds the current KnowledgeBase for a file and hot-reloads it from a background thread.
+
+    A replacement is built completely off the request path and then published with a single
+    reference assignment, so a rerun that already holds `current` keeps using the old version
+    while the next rerun picks up the new one. Nothing here ever blocks the UI.
+    """
+
+    def __init__(self, file_path, knowledge_base, signature):
+        self.file_path = file_path
+        self.current = knowledge_base
+        self.last_error = None
+        self.reload_count = 0
+        self._signature = signature
+        self._pending_signature = None
+        self._thread = threading.Thread(target=self._watch, name=f"kb-watcher:{file_path}", daemon=True)
+        self._thread.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(RELOAD_POLL_SECONDS)
+            try:
+                self.check_for_changes()
+            except Exception:
+                logger.exception("Knowledge base watcher failed while checking '%s'", self.file_path)
+
+    def check_for_changes(self):
+        """Rebuilds and swaps in the knowledge base if the file changed. Returns True if a swap happened."""
+        signature = get_file_signature(self.file_path)
+        if signature is None or signature == self._signature:
+            self._pending_signature = None
+            return False
+
+        # Wait for the signature to be stable across two polls so a half-written file is never loaded
+        if signature != self._pending_signature:
+            self._pending_signature = signature
+            return False
+        self._pending_signature = None
+        self._signature = signature
+
+        try:
+            knowledge_base = build_knowledge_base(self.file_path, previous=self.current)
+        except KnowledgeBaseError as e:
+            # Keep serving the previous version; the next change to the file triggers another attempt
+            self.last_error = str(e)
+            logger.warning("Keeping the previous knowledge base, reload of '%s' failed: %s", self.file_path, e)
+            return False
+
+        previous = self.current
+        knowledge_base.start_shard_pool()
+        self.current = knowledge_base
+        previous.stop_shard_pool()
+        self.last_error = None
+        self.reload_count += 1
+        logger.info("Reloaded knowledge base '%s' (version %s)", self.file_path, knowledge_base.version)
+        return True
+
+@st.cache_resource(show_spinner="Loading knowledge base...")
+def _start_knowledge_base_watcher(file_path):
+    """Builds the knowledge base once per process and starts its watcher; shared across reruns and sessions."""
+    signature = get_file_signature(file_path)
+    knowledge_base = build_knowledge_base(file_path)
+    # Start the shard workers (if any) before the first query
+    knowledge_base.start_shard_pool()
+    return KnowledgeBaseWatcher(file_path, knowledge_base, signature)
+
+def get_knowledge_base_watcher(file_path):
+    """Returns the process-wide watcher for the file, or None (after reporting the error) if it cannot be loaded."""
+    try:
+        return _start_knowledge_base_watcher(file_path)
+    except KnowledgeBaseError as e:
+        st.error(str(e))
+        if e.hint:
+            st.info(e.hint)
+        return None
+
+# --- Query Result Cache ---
+
+class QueryCache:
+    """
+    Bounded LRU of find_best_answer results, shared by every session. Entries live at most ttl_seconds and
+    belong to one knowledge base version: the first lookup against a new version drops them all.
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_SIZE, ttl_seconds=QUERY_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, result), least recently used first
+        self._lock = threading.Lock()
+
+    def _check_version(self, version):
+        if version != self.version:
+            self._entries.clear()
+            self.version = version
+
+    def get(self, version, key):
+        """Returns the cached result, or None on a miss (counted either way)."""
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, version, key, result):
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+@st.cache_resource
+def get_query_cache():
+    """The process-wide query result cache."""
+    return QueryCache()
+
+def find_best_answer_cached(query, knowledge_base, search_stats=None):
+    """
+    find_best_answer through the shared query cache. A knowledge base without a version (its source could not
+    be hashed) is never cached. On a hit, search_stats only receives {'cache_hit': True}.
+    Every served query is recorded for the scorer benchmark (see log_query).
+    """
+    log_query(query)
+    cache = get_query_cache()
+    if cache.max_entries <= 0 or knowledge_base.version is None:
+        return find_best_answer(query, knowledge_base, search_stats)
+
+    key = knowledge_base.cache_key(query)
+    result = cache.get(knowledge_base.version, key)
+    if result is not None:
+        if search_stats is not None:
+            search_stats['cache_hit'] = True
+        return result
+    result = find_best_answer(query, knowledge_base, search_stats)
+    cache.put(knowledge_base.version, key, result)
+    return result
+
+def format_single_code_details(access_code, matched_df, setting_item_name=None, matched_row=None):
+    """Formats the detailed output for a single, known Access Code (pointing out matched_row when it was found by its text)."""
     
-    # Get the common header values
-    setting_item_name = str(matched_df.iloc[0]['Setting item name'])
+    # Get the common header values (precomputed by the group index when available)
+    if setting_item_name is None:
+        setting_item_name = matched_df.iloc[0]['Setting item name']
+    setting_item_name = str(setting_item_name)
 
     # --- A. Format the Header Block ---
     header_block = (
         f"**08 Code:**\t`{access_code}`\n\n"
         f"**Setting Item Name:**\t{setting_item_name}\n\n"
     )
+    if matched_row is not None:
+        description = matched_row.get('Description of values')
+        description = f" ({description})" if pd.notna(description) and str(description).strip() else ""
+        header_block += f"**Matched option:**\t`{matched_row['Sub Code']}` {matched_row['Meaning of sub code']}{description}\n\n"
 
     # --- B. Prepare the Sub-Table Data ---
     sub_table_df = matched_df[[
@@ -117,41 +2579,85 @@ def format_ambiguous_output(matched_codes, score):
     )
     return (True, formatted_answer)
 
+def find_structured_answer(query, knowledge_base):
+    """
+    Answers a structured code query (a range, a whole family or the codes near a number) from the sorted code
+    index: up to STRUCTURED_MAX_DETAILS codes are shown in full, more are listed like an ambiguous result so
+    "show all" works on them. Returns None when the query is not structured or nothing matches it.
+    """
+    parsed = parse_structured_query(query)
+    if parsed is None:
+        return None
+    kind, family, *numbers = parsed
+    if kind == 'range':
+        codes = knowledge_base.codes_in_range(family, *numbers)
+    elif kind == 'family':
+        codes = knowledge_base.codes_in_range(family)
+    else:
+        codes = knowledge_base.codes_near(numbers[0], family)
+    if not codes:
+        return None
+
+    if len(codes) > STRUCTURED_MAX_DETAILS:
+        listed = codes[:STRUCTURED_MAX_LISTED]
+        code_list = "\n".join(f"* `{code}`" for code in listed)
+        if len(codes) > len(listed):
+            code_list += f"\n\n...and {len(codes) - len(listed)} more."
+        snippet = STRUCTURED_LIST_SNIPPET.format(count=len(codes))
+        return (True, f"### Ambiguous Search Result\n\n{snippet}\n\n{code_list}")
 
-def find_best_answer(query, df):
+    combined_details = "".join(
+        details for details in (knowledge_base.render_details(code) for code in codes) if details is not None
+    )
+    return (True, f"{STRUCTURED_MATCH_SNIPPET.format(count=len(codes))}\n\n{combined_details}")
+
+
+def find_best_answer(query, knowledge_base, search_stats=None):
     """
-    Searches the DataFrame against 'Access Code' and 'Setting item name'.
+    Searches the knowledge base against 'Access Code' and 'Setting item name'.
     Lists all codes that achieve the best score, regardless of whether that score is 100%.
+    A query that is exactly an Access Code (up to case, separators, spacing and full-width characters)
+    is answered by a hash lookup without any fuzzy scoring. Codes also match by the meanings and descriptions of
+    their sub codes (BM25); an answer found that way points out the sub code row that matched. Codes a typo or
+    two away from the query (e.g. transposed digits) match through the BK-tree as Access Code matches.
+    Structured queries ("PR-400 to PR-450", "all SC codes", "codes near 905") list the codes they select.
+    If a dict is passed as search_stats, it receives the matcher's candidate and pruning counts.
     """
-    best_score = 0
-    score_to_codes = {} 
-    
-    # 1. FIND THE BEST MATCHING SCORE AND IDENTIFY ALL CODES THAT ACHIEVE IT
-    for access_code in df['Access Code'].unique():
-        
-        setting_name = df[df['Access Code'] == access_code]['Setting item name'].iloc[0]
-        
-        # Search 1: Fuzzy score against the Access Code
-        score_code = fuzz.token_set_ratio(query.lower(), str(access_code).lower())
-        
-        # Search 2: Fuzzy score against the Setting Item Name
-        score_name = fuzz.token_set_ratio(query.lower(), str(setting_name).lower())
-        
-        # Take the maximum score from the two searches
-        current_max_score = max(score_code, score_name)
-
-        if current_max_score > best_score:
-            best_score = current_max_score
-            score_to_codes = {best_score: [access_code]}
-        elif current_max_score == best_score and current_max_score >= MIN_MATCH_SCORE:
-            score_to_codes.setdefault(best_score, []).append(access_code)
+    # 0. FAST PATH: EXACT (CANONICAL) ACCESS CODE
+    exact_codes = knowledge_base.exact_matches(query)
+    if len(exact_codes) > 1:
+        return format_ambiguous_output(exact_codes, 100)
+    if exact_codes:
+        formatted_answer = knowledge_base.render_details(exact_codes[0])
+        if formatted_answer is not None:
+            return (True, formatted_answer)
+
+    # 0b. STRUCTURED QUERIES: code ranges, families and neighbourhoods, answered from the sorted code index
+    structured_answer = find_structured_answer(query, knowledge_base)
+    if structured_answer is not None:
+        return structured_answer
+
+    # 1. SCORE THE CANDIDATES IN ONE BATCH (best of Access Code and Setting Item Name per code), blended with the
+    #    typo and full-text matches; fuzzy candidates that cannot reach the best of those are pruned
+    text_scores, text_rows = knowledge_base.text_matches(query)
+    typo_scores = knowledge_base.typo_matches(query)
+    floor = max([MIN_MATCH_SCORE] + [int(extra.max()) for extra in (text_scores, typo_scores) if extra is not None and len(extra)])
+    codes, code_scores, name_scores, stats = knowledge_base.score_fields(query, floor, top=1)
+    if typo_scores is not None:
+        code_scores = np.maximum(code_scores, typo_scores)
+    fuzzy_scores = np.maximum(code_scores, name_scores)
+    scores = fuzzy_scores if text_scores is None else np.maximum(fuzzy_scores, text_scores)
+    logger.debug("Query %r: scored %d of %d candidates (%d pruned by score bounds)", query, stats['scored'], stats['candidates'], stats['pruned'])
+    if search_stats is not None:
+        search_stats.update(stats)
+    best_score = int(scores.max()) if len(scores) else 0
             
     # 2. CHECK THRESHOLD
-    if best_score < MIN_MATCH_SCORE or not score_to_codes:
+    if best_score < MIN_MATCH_SCORE:
         return (False, None) # No good match found
 
     # Get the list of codes that achieved the best score
-    best_score_codes = list(set(score_to_codes[best_score]))
+    best_score_codes = [codes[i] for i in np.flatnonzero(scores == best_score)]
     
     # 3. AMBIGUITY CHECK: If multiple unique codes share the best score, ask for clarification.
     if len(best_score_codes) > 1:
@@ -160,17 +2666,75 @@ def find_best_answer(query, df):
     # 4. HANDLE SINGLE BEST MATCH
     best_match_code = best_score_codes[0]
         
-    # 5. RETRIEVE ALL ROWS AND FORMAT DETAILS FOR THE SINGLE CODE
-    matched_df = df[df['Access Code'] == best_match_code].copy()
+    # 5. RETRIEVE ALL ROWS AND FORMAT DETAILS FOR THE SINGLE CODE (rendered once per version of the code)
+    best_position = int(np.flatnonzero(scores == best_score)[0])
+    if text_scores is not None and text_scores[best_position] > fuzzy_scores[best_position]:
+        formatted_answer = knowledge_base.render_text_match(best_match_code, text_rows[best_position])
+    else:
+        formatted_answer = knowledge_base.render_details(best_match_code)
         
-    if matched_df.empty:
+    if formatted_answer is None:
         return (False, None)
-
-    formatted_answer = format_single_code_details(best_match_code, matched_df)
     
     return (True, formatted_answer)
 
 
+def search(query, knowledge_base, k=SEARCH_TOP_K, min_score=MIN_MATCH_SCORE):
+    """
+    Ranked search: returns up to k codes scoring at least min_score, best first (ties in catalog order), as dicts
+    with the Access Code, its setting name, the score, which field matched and, for a text match, the sub code.
+    Exact (canonical) Access Code matches rank first at 100. Only a k-sized heap is kept, whatever the number of
+    candidates.
+    """
+    if k <= 0:
+        return []
+    codes, code_scores, name_scores, _ = knowledge_base.score_fields(query, min_score, top=k)
+    typo_scores = knowledge_base.typo_matches(query)
+    if typo_scores is not None:
+        code_scores = np.maximum(code_scores, typo_scores)
+    text_scores, text_rows = knowledge_base.text_matches(query)
+    if text_scores is None:
+        text_scores = np.zeros(len(codes), dtype=np.int64)
+    exact_codes = knowledge_base.exact_matches(query)
+    exact_ranks = {code: len(exact_codes) - i for i, code in enumerate(exact_codes)}
+
+    def entries():
+        for code in exact_codes:
+            yield (100, exact_ranks[code], 0, code, 'Access Code', None)
+        for i in np.flatnonzero(np.maximum.reduce([code_scores, name_scores, text_scores]) >= max(min_score, 1)):
+            code = codes[i]
+            if code not in exact_ranks:
+                if text_scores[i] > max(code_scores[i], name_scores[i]):
+                    yield (int(text_scores[i]), 0, -int(i), code, 'Meaning/Description', knowledge_base.sub_code_at(text_rows[int(i)]))
+                else:
+                    field = 'Access Code' if code_scores[i] >= name_scores[i] else 'Setting item name'
+                    yield (int(max(code_scores[i], name_scores[i])), 0, -int(i), code, field, None)
+
+    return [
+        {'access_code': code, 'setting_name': knowledge_base.setting_name_for(code), 'score': score, 'field': field, 'sub_code': sub_code}
+        for score, _, _, code, field, sub_code in heapq.nlargest(k, entries())
+    ]
+
+def autocomplete(text, knowledge_base, limit=AUTOCOMPLETE_LIMIT):
+    """Type-ahead suggestions for a partial query: (Access Code, setting name) pairs, best first."""
+    if not text or not text.strip():
+        return []
+    return [(code, knowledge_base.setting_name_for(code)) for code in knowledge_base.complete(text, limit)]
+
+def queue_prompt(prompt):
+    """Button callback: the next rerun handles `prompt` as if it had been typed into the chat."""
+    st.session_state.pending_prompt = prompt
+
+def format_suggestions(results):
+    """Formats near-miss search() results as a short markdown list (not the ambiguous-result bullets)."""
+    lines = [
+        f"- `{result['access_code']}` {result['setting_name']} ({result['score']}%, matched on {result['field']}"
+        + (f" of sub code `{result['sub_code']}`)" if result['sub_code'] is not None else ")")
+        for result in results
+    ]
+    return f"{SUGGESTIONS_SNIPPET}\n\n" + "\n".join(lines)
+
+
 # The analyze_prompt_for_multiple_intents function remains unchanged.
 def analyze_prompt_for_multiple_intents(prompt):
     """Analyzes the prompt to separate a greeting/small talk from the core query."""
@@ -195,10 +2759,16 @@ def analyze_prompt_for_multiple_intents(prompt):
 
 # --- Streamlit App Interface (Contains new logic for "Show All" and fix for NameError) ---
 
-# Load the data once at the start
-data_df = load_data(CSV_FILE_NAME)
+# Load the data once per process; the watcher hot-swaps it when the file changes.
+# Take a single reference so this whole rerun works against one consistent version.
+# Spawned worker processes (see ShardPool) run this script only for its functions
+if multiprocessing.current_process().name == 'MainProcess':
+    knowledge_base_watcher = get_knowledge_base_watcher(CSV_FILE_NAME)
+    knowledge_base = knowledge_base_watcher.current if knowledge_base_watcher is not None else None
+else:
+    knowledge_base = None
 
-if data_df is not None:
+if knowledge_base is not None:
     st.set_page_config(page_title="UseCaseGen-08", layout="centered")
     st.title(" 🚀 UseCaseGen-08 ")
     st.markdown("Try searching by **08 Code** (e.g., 'PR-401') OR **Setting Item Name** (e.g., 'Print Quality Mode').")
@@ -214,7 +2784,13 @@ if data_df is not None:
             st.markdown(message["content"])
 
     # Accept user input
-    if prompt := st.chat_input("Enter the 08 code or a query..."):
+    # Type-ahead: suggestions for a partial code or setting name; picking one asks about it in the chat
+    partial_query = st.sidebar.text_input("Quick lookup", placeholder="e.g. PR-4 or print qu", help="Type the start of an 08 Code or setting name, then press Enter.")
+    for code, setting_name in autocomplete(partial_query, knowledge_base):
+        st.sidebar.button(f"{code} · {setting_name}", key=f"autocomplete-{code}", on_click=queue_prompt, args=(code,))
+
+    # Accept user input (typed, or picked from the type-ahead suggestions)
+    if prompt := st.chat_input("Enter the 08 code or a query...") or st.session_state.pop('pending_prompt', None):
         st.session_state.messages.append({"role": "user", "content": prompt})
         
         with st.chat_message("user"):
@@ -229,6 +2805,7 @@ if data_df is not None:
                 # Initialize variables to avoid NameError
                 csv_answer = ""
                 csv_match_found = False
+                search_stats = {}
 
                 if greeting_response:
                     final_response += greeting_response
@@ -251,9 +2828,9 @@ if data_df is not None:
                             # 2. Process and combine details for all extracted codes
                             combined_details = ""
                             for code in matched_codes:
-                                matched_df = data_df[data_df['Access Code'] == code].copy()
-                                if not matched_df.empty:
-                                    combined_details += format_single_code_details(code, matched_df)
+                                details = knowledge_base.render_details(code)
+                                if details is not None:
+                                    combined_details += details
                             
                             final_response += combined_details
                             csv_match_found = True
@@ -264,10 +2841,10 @@ if data_df is not None:
                             csv_match_found = False
                     
                     else: # Not a "Show All" command or no previous ambiguous result
-                        csv_match_found, csv_answer = find_best_answer(search_query, data_df)
+                        csv_match_found, csv_answer = find_best_answer_cached(search_query, knowledge_base, search_stats)
                 
                 else: # Fresh chat or only one previous message
-                    csv_match_found, csv_answer = find_best_answer(search_query, data_df)
+                    csv_match_found, csv_answer = find_best_answer_cached(search_query, knowledge_base, search_stats)
                 # --- END CONTEXTUAL LOGIC ---
                 
                 # --- FORMATTING OUTPUT ---
@@ -301,9 +2878,79 @@ if data_df is not None:
                     else:
                         final_response = CSV_NOT_FOUND_SNIPPET
 
+                    # Offer the near misses, if any, instead of a dead end
+                    if search_query.strip():
+                        suggestions = search(search_query, knowledge_base, SUGGESTION_COUNT, SUGGESTION_MIN_SCORE)
+                        if suggestions:
+                            final_response += f"\n\n{format_suggestions(suggestions)}"
+
                 st.markdown(final_response)
+                if search_stats:
+                    st.session_state.last_search_stats = search_stats
 
         st.session_state.messages.append({"role": "assistant", "content": final_response})
 
     st.sidebar.subheader("Configuration")
     st.sidebar.info(f"Using **{CSV_FILE_NAME}** as the knowledge base. \n\nMinimum match score: **{MIN_MATCH_SCORE}%**")
+    if knowledge_base.load_stats:
+        stats = knowledge_base.load_stats
+        memory = f", {stats['memory_bytes'] / 1024 / 1024:,.1f} MB in memory" if 'memory_bytes' in stats else ""
+        st.sidebar.caption(
+            f"Loaded {stats['rows']:,} rows from {stats['files']} file(s) in {stats['seconds']:.2f}s "
+            f"({stats['rows_per_second']:,.0f} rows/sec, {stats['reader']} reader){memory}"
+        )
+    if getattr(knowledge_base, 'delta', None):
+        delta = knowledge_base.delta
+        st.sidebar.caption(f"Last reload: {delta['changed']} changed, {delta['added']} added, {delta['removed']} removed, {delta['unchanged']} unchanged codes")
+    if st.session_state.get('last_search_stats'):
+        search_stats = st.session_state.last_search_stats
+        if search_stats.get('cache_hit'):
+            st.sidebar.caption("Last search: answered from the query cache")
+        elif 'scored' in search_stats:
+            st.sidebar.caption(
+                f"Last search: scored {search_stats['scored']:,} of {search_stats['candidates']:,} candidate fields "
+                f"({search_stats['pruned']:,} pruned by score bounds; {search_stats['fields']:,} fields in the catalog)"
+                + (f", across {search_stats['shards']} shard workers" if 'shards' in search_stats else "")
+            )
+    query_cache = get_query_cache()
+    lookups = query_cache.hits + query_cache.misses
+    if lookups:
+        st.sidebar.caption(
+            f"Query cache: {query_cache.hits:,} hits / {query_cache.misses:,} misses "
+            f"({query_cache.hits / lookups:.0%} hit rate), {len(query_cache):,} of {query_cache.max_entries:,} entries"
+        )
+    quality_report = getattr(knowledge_base, 'quality_report', None)
+    if quality_report:
+        issues = count_quality_issues(quality_report)
+        with st.sidebar.expander(f"Data quality: {issues} issue(s)" if issues else "Data quality: no issues found"):
+            st.markdown(
+                f"Checked {quality_report['rows']:,} rows / {quality_report['codes']:,} codes in {quality_report['seconds'] * 1000:.0f} ms.\n\n"
+                f"* Duplicate (code, sub code) pairs: **{quality_report['duplicate_pairs']}**\n"
+                f"* Codes with differing setting names: **{quality_report['inconsistent_names']}**\n"
+                f"* Codes not matching `{ACCESS_CODE_PATTERN}`: **{quality_report['malformed_codes']}**\n"
+                f"* Blank cells: " + ", ".join(f"{column} **{count}**" for column, count in quality_report['blank_cells'].items())
+            )
+            for label, key in (
+                ("Duplicate pairs", 'duplicate_pair_samples'),
+                ("Differing setting names", 'inconsistent_name_samples'),
+                ("Malformed codes", 'malformed_code_samples'),
+            ):
+                if quality_report[key]:
+                    st.caption(f"{label}: " + ", ".join(f"`{sample}`" for sample in quality_report[key]))
+    processed_fields = (getattr(knowledge_base, 'processed_codes', None), getattr(knowledge_base, 'processed_names', None))
+    if processed_fields[0] is not None:
+        with st.sidebar.expander("Scorer benchmark"):
+            st.caption(f"In use: **{CODE_SCORER}** for Access Codes, **{NAME_SCORER}** for Setting Item Names")
+            if st.button("Run benchmark", help=f"Scores every code with each scorer over the last {SCORER_BENCHMARK_QUERIES} queries served (or sample queries drawn from the catalog until some are served)."):
+                queries, source = load_benchmark_queries(processed_fields)
+                st.session_state.scorer_benchmark = (knowledge_base.version, source, len(queries), benchmark_scorers(processed_fields, queries))
+            benchmark = st.session_state.get('scorer_benchmark')
+            if benchmark and benchmark[0] == knowledge_base.version:
+                _, source, query_count, results = benchmark
+                st.caption(f"{query_count:,} queries from {source}; agreement is the share of queries answered like token_set.")
+                st.markdown(pd.DataFrame([
+                    {'Scorer': result['scorer'], 'Queries/sec': f"{result['queries_per_second']:,.0f}", 'Agreement': f"{result['agreement']:.0%}"}
+                    for result in results
+                ]).to_markdown(index=False))
+    if knowledge_base_watcher.last_error:
+        st.sidebar.warning(f"The knowledge base file changed but could not be reloaded, still serving the previous version. {knowledge_base_watcher.last_error}")
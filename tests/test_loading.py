@@ -0,0 +1,37 @@
+"""
+Checks of the source readers: every column is read as text whatever the reader, so all-digit codes keep their
+leading zeros.
+Run from the repository root: python -m pytest -q
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+ALL_DIGIT_CSV = (
+    'Access Code,Setting item name,Sub Code,Meaning of sub code,Description of values,Notes\n'
+    '0801,Print density,00,Light,,ignored\n'
+    '0801,Print density,01,Dark,Darker than 00,ignored\n'
+    '0802,Toner saver,00,Off,,ignored\n'
+)
+
+
+@pytest.mark.parametrize('use_pyarrow', [True, False])
+def test_csv_keeps_leading_zeros(tmp_path, monkeypatch, use_pyarrow):
+    if use_pyarrow and app.pyarrow is None:
+        pytest.skip('pyarrow is not installed')
+    if not use_pyarrow:
+        monkeypatch.setattr(app, 'pyarrow', None)
+    path = tmp_path / 'family.csv'
+    path.write_text(ALL_DIGIT_CSV, encoding='utf-8-sig')
+
+    df = app.load_data(str(path))
+    assert list(df['Access Code']) == ['0801', '0801', '0802']
+    assert list(df['Sub Code']) == ['00', '01', '00']
+    assert 'Notes' not in df.columns
+
+    kb = app.KnowledgeBase(df, 'test')
+    assert kb.exact_matches('0801') == ['0801']
@@ -0,0 +1,139 @@
+"""
+Brute-force checks of the matcher: find_best_answer() and search() must give the same answers as scoring every code
+with fuzzywuzzy's token_set_ratio, both in-process and with the catalog split across shard workers. The n-gram
+prefilter and the score-bound pruning may only skip codes that could not have changed the answer.
+Run from the repository root: python -m pytest -q
+"""
+import os
+import random
+import string
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+from fuzzywuzzy import fuzz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+WORDS = [
+    'print', 'quality', 'mode', 'scanner', 'calibration', 'network', 'protocol', 'paper', 'tray', 'size', 'toner',
+    'density', 'fax', 'speed', 'color', 'duplex', 'feed', 'energy', 'saver', 'timer', 'sleep', 'USB', 'port',
+    'address', 'email', 'font', 'margin', 'offset',
+]
+FAMILIES = ['PR', 'SC', 'NW', 'FX', 'CP', 'EN']
+
+
+def synthetic_catalog(n_codes, seed):
+    """A catalog of near-duplicates: codes a digit apart and setting names drawn from a small shared vocabulary."""
+    rnd = random.Random(seed)
+    codes, rows = set(), []
+    while len(codes) < n_codes:
+        code = f"{rnd.choice(FAMILIES)}-{rnd.randint(100, 999)}"
+        if code in codes:
+            continue
+        codes.add(code)
+        name = ' '.join(rnd.sample(WORDS, rnd.randint(1, 4)))
+        for sub in range(rnd.randint(1, 3)):
+            rows.append([code, name, f"{sub:02d}", f"meaning {rnd.choice(WORDS)} {sub}", f"desc {rnd.choice(WORDS)}"])
+    return pd.DataFrame(rows, columns=['Access Code', 'Setting item name', 'Sub Code', 'Meaning of sub code', 'Description of values'])
+
+
+def sample_queries(df, n, seed):
+    """Codes and names as typed, with a character changed, cut short, or mixed with other words."""
+    rnd = random.Random(seed)
+    codes = list(df['Access Code'].unique())
+    names = list(df['Setting item name'].unique())
+    queries = ['hi', 'xyz', '', '   ', 'PR', '401', 'network', 'print quality', 'pr 401', 'nw 62', 'Network Protocol', 'é café']
+    for _ in range(n):
+        choice = rnd.random()
+        if choice < 0.3:
+            query = rnd.choice(codes)
+        elif choice < 0.5:
+            query = rnd.choice(names)
+        elif choice < 0.7:
+            query = rnd.choice(codes + names)
+            i = rnd.randrange(len(query))
+            query = query[:i] + rnd.choice(string.ascii_letters + string.digits + ' -') + query[i + 1:]
+        elif choice < 0.85:
+            query = rnd.choice(rnd.choice(names).split()) + ' ' + rnd.choice(['mode', 'x', '', 'timer'])
+        else:
+            query = rnd.choice(codes)[:rnd.randint(1, 6)]
+        queries.append(query)
+    return queries
+
+
+def brute_force_knowledge_base(df):
+    """A KnowledgeBase whose score_fields() runs fuzzywuzzy over every code: no index, no pruning."""
+    kb = app.KnowledgeBase(df.copy(), 'brute-force')
+
+    def score_fields(query, min_score=app.MIN_MATCH_SCORE, top=None):
+        query = query.lower()
+        code_scores = np.array([fuzz.token_set_ratio(query, str(code).lower()) for code in kb.access_codes], dtype=np.int64)
+        name_scores = np.array([fuzz.token_set_ratio(query, str(kb.setting_name_for(code)).lower()) for code in kb.access_codes], dtype=np.int64)
+        n = len(kb.access_codes)
+        return kb.access_codes, code_scores, name_scores, {'fields': 2, 'candidates': n, 'scored': n, 'pruned': 0}
+
+    kb.score_fields = score_fields
+    return kb
+
+
+@pytest.fixture(scope='module')
+def catalog():
+    df = synthetic_catalog(300, seed=7)
+    return df, brute_force_knowledge_base(df), sample_queries(df, 150, seed=1)
+
+
+def assert_same_answers(kb, reference, queries):
+    for query in queries:
+        assert app.find_best_answer(query, kb) == app.find_best_answer(query, reference), query
+        for k in (1, app.SEARCH_TOP_K):
+            for min_score in (app.MIN_MATCH_SCORE, 40):
+                assert app.search(query, kb, k, min_score) == app.search(query, reference, k, min_score), (query, k, min_score)
+
+
+@pytest.mark.parametrize('chunk_size', [app.SCORING_CHUNK_SIZE, 16])
+def test_matches_brute_force(catalog, monkeypatch, chunk_size):
+    # Small chunks raise the pruning threshold between chunks, as on a catalog of many thousand codes
+    df, reference, queries = catalog
+    monkeypatch.setattr(app, 'SCORING_CHUNK_SIZE', chunk_size)
+    kb = app.KnowledgeBase(df.copy(), 'in-process')
+    assert kb.shard_pool is None
+    assert_same_answers(kb, reference, queries)
+
+
+@pytest.fixture
+def sharded_knowledge_base(catalog, monkeypatch):
+    monkeypatch.setattr(app, 'SEARCH_SHARDS', 2)
+    monkeypatch.setattr(app, 'SHARDED_SEARCH_MIN_CODES', 0)
+    kb = app.KnowledgeBase(catalog[0].copy(), 'sharded')
+    kb.start_shard_pool()
+    yield kb
+    kb.stop_shard_pool()
+
+
+def test_sharded_matches_brute_force(catalog, sharded_knowledge_base):
+    _, reference, queries = catalog
+    assert sharded_knowledge_base.shard_pool is not None
+    assert_same_answers(sharded_knowledge_base, reference, queries)
+
+
+def test_sharded_queries_run_concurrently(catalog, sharded_knowledge_base):
+    # Queries from several sessions are in flight at once; every reply must still reach the query that sent it
+    _, reference, queries = catalog
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        answers = list(pool.map(lambda query: app.search(query, sharded_knowledge_base, app.SEARCH_TOP_K, 40), queries))
+    assert answers == [app.search(query, reference, app.SEARCH_TOP_K, 40) for query in queries]
+
+
+def test_sharded_search_survives_a_dead_worker(catalog, sharded_knowledge_base):
+    _, reference, queries = catalog
+    _, process = sharded_knowledge_base.shard_pool._shards[0]
+    process.kill()
+    process.join()
+    # The pool closes itself and the query is scored in this process instead
+    assert app.search(queries[0], sharded_knowledge_base) == app.search(queries[0], reference)
+    assert sharded_knowledge_base.shard_pool.closed
+    assert_same_answers(sharded_knowledge_base, reference, queries[:20])
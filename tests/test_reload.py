@@ -0,0 +1,94 @@
+"""
+Checks of the delta reload: a KnowledgeBase built from the version it replaces (reusing the derived strings, n-gram
+and BM25 postings and BK-tree of its unchanged codes) must equal one built from scratch, structure for structure and
+answer for answer.
+Run from the repository root: python -m pytest -q
+"""
+import os
+import random
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+from test_matching import WORDS, sample_queries, synthetic_catalog  # noqa: E402
+
+
+def edited_catalog(df, seed):
+    """df with codes removed, changed (setting name or a sub code's meaning), added and the code order shuffled."""
+    rnd = random.Random(seed)
+    codes = list(df['Access Code'].unique())
+    removed = set(rnd.sample(codes, 30))
+    renamed = set(rnd.sample([code for code in codes if code not in removed], 20))
+    reworded = set(rnd.sample([code for code in codes if code not in removed | renamed], 20))
+    df = df[~df['Access Code'].isin(removed)].copy()
+    df.loc[df['Access Code'].isin(renamed), 'Setting item name'] += ' revised'
+    first_rows = df['Access Code'].isin(reworded) & ~df['Access Code'].duplicated()
+    df.loc[first_rows, 'Meaning of sub code'] = 'replaced wording ' + df.loc[first_rows, 'Access Code']
+
+    added = []
+    for i in range(25):
+        # New codes next to existing ones (typo neighbours in the BK-tree) and with words new to the BM25 index
+        code = f"{rnd.choice(codes)}{i % 10}"
+        added.append([code, f"added {rnd.choice(WORDS)} setting", '00', f"fresh{i} option {rnd.choice(WORDS)}", 'new'])
+    df = pd.concat([df, pd.DataFrame(added, columns=df.columns)], ignore_index=True)
+
+    # Reorder whole codes (each code's rows stay together and in order)
+    order = list(df['Access Code'].unique())
+    rnd.shuffle(order)
+    rank = {code: i for i, code in enumerate(order)}
+    return df.sort_values('Access Code', key=lambda column: column.map(rank), kind='stable').reset_index(drop=True)
+
+
+def ngram_postings(index):
+    return (
+        {gram: sorted(zip(positions.tolist(), counts.tolist())) for gram, (positions, counts) in index['grams'].items()},
+        {token: sorted(positions.tolist()) for token, positions in index['tokens'].items()},
+        index['lengths'].tolist(),
+    )
+
+
+def assert_same_text_index(index, expected):
+    assert index['rows'] == expected['rows']
+    assert set(index['postings']) == set(expected['postings'])
+    for term, (rows, weights) in expected['postings'].items():
+        order, expected_order = np.argsort(index['postings'][term][0]), np.argsort(rows)
+        assert index['postings'][term][0][order].tolist() == rows[expected_order].tolist(), term
+        np.testing.assert_allclose(index['postings'][term][1][order], weights[expected_order], err_msg=term)
+    assert index['idf'] == pytest.approx(expected['idf'])
+
+
+def assert_same_knowledge_base(kb, expected, queries):
+    assert kb.access_codes == expected.access_codes
+    for attribute in ('processed_codes', 'processed_names', 'code_token_sets', 'name_token_sets', 'canonical_forms'):
+        assert getattr(kb, attribute) == getattr(expected, attribute), attribute
+    assert ngram_postings(kb.code_ngram_index) == ngram_postings(expected.code_ngram_index)
+    assert ngram_postings(kb.name_ngram_index) == ngram_postings(expected.name_ngram_index)
+    assert_same_text_index(kb.text_index, expected.text_index)
+
+    for canonical in expected.canonical_forms:
+        for key in (canonical, canonical[::-1], canonical[:-1] + 'x'):
+            assert sorted(app.bk_tree_search(kb.code_bk_tree, key, app.TYPO_MAX_DISTANCE)) == sorted(
+                app.bk_tree_search(expected.code_bk_tree, key, app.TYPO_MAX_DISTANCE)
+            ), key
+    for query in queries:
+        assert app.find_best_answer(query, kb) == app.find_best_answer(query, expected), query
+        assert app.search(query, kb) == app.search(query, expected), query
+
+
+def test_delta_reload_matches_full_build():
+    df1 = synthetic_catalog(300, seed=11)
+    df2 = edited_catalog(df1, seed=5)
+    queries = sample_queries(df2, 100, seed=2) + ['replaced wording', 'fresh3 option', 'added setting', 'meaning toner']
+
+    first = app.KnowledgeBase(df1.copy(), 'v1')
+    reloaded = app.KnowledgeBase(df2.copy(), 'v2', previous=first)
+    assert all(reloaded.delta[kind] > 0 for kind in ('unchanged', 'changed', 'added', 'removed')), reloaded.delta
+    assert_same_knowledge_base(reloaded, app.KnowledgeBase(df2.copy(), 'v2'), queries)
+
+    # And back again: the removed codes return, and BK-tree nodes left without codes must not get in the way
+    restored = app.KnowledgeBase(df1.copy(), 'v3', previous=reloaded)
+    assert_same_knowledge_base(restored, app.KnowledgeBase(df1.copy(), 'v3'), sample_queries(df1, 100, seed=3))
@@ -0,0 +1,128 @@
+"""
+Checks of the sidecar snapshot: a KnowledgeBase saved and loaded back answers like the original, and a corrupt,
+foreign or planted .kbcache file is refused (load_sidecar returns None) without running any of its content.
+Run from the repository root: python -m pytest -q
+"""
+import io
+import json
+import math
+import os
+import pickle
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+from test_matching import sample_queries, synthetic_catalog  # noqa: E402
+
+pytestmark = pytest.mark.skipif(app.pyarrow is None, reason='the sidecar stores the frame as Parquet (pyarrow)')
+
+
+def awkward_catalog():
+    """Codes starting with '!' (so dict keys do too) and setting names left blank."""
+    df = synthetic_catalog(200, seed=4)
+    codes = df['Access Code'].unique()
+    df.loc[df['Access Code'].isin(codes[:10]), 'Access Code'] = '!' + df['Access Code']
+    df.loc[df['Access Code'].isin(codes[10:20]), 'Setting item name'] = np.nan
+    return df
+
+
+def without_nan(results):
+    """search() results with blank (NaN) setting names as None, so equal results compare equal."""
+    return [{key: None if isinstance(value, float) and math.isnan(value) else value for key, value in result.items()} for result in results]
+
+
+def round_trip(value):
+    arrays = {}
+    encoded = json.dumps(app._encode_snapshot(value, arrays))
+    buffers = {dtype: np.concatenate(chunks) for dtype, (chunks, _) in arrays.items()}
+    return json.loads(encoded, object_hook=lambda obj: app._decode_snapshot_object(obj, buffers))
+
+
+def test_encoding_round_trip():
+    value = {
+        'tuple': (1, 'a', (2.5, None)),
+        'edges': [{1: 2, 3: 4}, {}],
+        'int keys': {7: [1, 2], 8: ('x',)},
+        # One-key dicts whose key looks like one of the encoder's tags
+        '!bang': [{'!tuple': [1, 2]}, {'!array': 'not an array'}, {'!dict': []}, {'!x': 1, '!y': 2}],
+        'nan': [float('nan'), 1.0],
+        'arrays': (np.arange(5, dtype=np.int32), np.linspace(0, 1, 6).reshape(2, 3), np.zeros(0, dtype=np.int64)),
+    }
+    decoded = round_trip(value)
+    assert decoded['tuple'] == value['tuple']
+    assert decoded['edges'] == value['edges']
+    assert decoded['int keys'] == value['int keys']
+    assert decoded['!bang'] == value['!bang']
+    assert math.isnan(decoded['nan'][0]) and decoded['nan'][1] == 1.0
+    for array, expected in zip(decoded['arrays'], value['arrays']):
+        assert array.dtype == expected.dtype and array.shape == expected.shape
+        np.testing.assert_array_equal(array, expected)
+
+
+def test_sidecar_round_trip(tmp_path):
+    df = awkward_catalog()
+    kb = app.KnowledgeBase(df.copy(), 'test')
+    queries = sample_queries(df, 80, seed=6) + ['!' + code for code in df['Access Code'].unique()[:5]]
+    # Rendered details are part of the snapshot too
+    answers = [app.find_best_answer(query, kb) for query in queries]
+
+    path = str(tmp_path / 'catalog.csv.kbcache')
+    app.save_sidecar(path, 'source-hash', kb)
+    loaded = app.load_sidecar(path, 'source-hash')
+    assert loaded is not None
+    assert loaded.access_codes == kb.access_codes
+    assert loaded.code_bk_tree == kb.code_bk_tree
+    assert [app.find_best_answer(query, loaded) for query in queries] == answers
+    for query in queries:
+        assert without_nan(app.search(query, loaded)) == without_nan(app.search(query, kb)), query
+
+    # A snapshot of another source or version is stale
+    assert app.load_sidecar(path, 'other-hash') is None
+
+
+class Planted:
+    """Creates the marker file if it is ever unpickled."""
+
+    def __init__(self, marker):
+        self.marker = marker
+
+    def __reduce__(self):
+        return (open, (self.marker, 'w'))
+
+
+def test_sidecar_refuses_corrupt_and_foreign_files(tmp_path):
+    kb = app.KnowledgeBase(awkward_catalog(), 'test')
+    path = str(tmp_path / 'catalog.csv.kbcache')
+    app.save_sidecar(path, 'source-hash', kb)
+    with open(path, 'rb') as f:
+        valid = f.read()
+    with np.load(path, allow_pickle=False) as archive:
+        entries = {name: archive[name] for name in archive.files}
+
+    def npz_bytes(**overrides):
+        buffer = io.BytesIO()
+        np.savez(buffer, **{**entries, **overrides})
+        return buffer.getvalue()
+
+    marker = str(tmp_path / 'unpickled')
+    header = json.loads(entries['header'].tobytes())
+    foreign = {
+        'random bytes': os.urandom(4096),
+        'truncated': valid[:len(valid) // 2],
+        'empty': b'',
+        'pickle': pickle.dumps(Planted(marker)),
+        'object array': npz_bytes(state=np.array([Planted(marker)], dtype=object)),
+        'other format': npz_bytes(header=np.frombuffer(json.dumps({**header, 'format': -1}).encode('utf-8'), dtype=np.uint8)),
+        'bad json': npz_bytes(state=np.frombuffer(b'{"access_codes": [', dtype=np.uint8)),
+        'missing array': npz_bytes(state=np.frombuffer(b'{"x": {"!array": ["<f2", 0, [3]]}}', dtype=np.uint8)),
+        'no frame': npz_bytes(frame=np.frombuffer(b'not parquet', dtype=np.uint8)),
+    }
+    for name, content in foreign.items():
+        with open(path, 'wb') as f:
+            f.write(content)
+        assert app.load_sidecar(path, 'source-hash') is None, name
+    assert not os.path.exists(marker)
+    assert app.load_sidecar(str(tmp_path / 'missing.kbcache'), 'source-hash') is None
@@ -0,0 +1,30 @@
+"""
+Checks of the structured queries: the SQLite backend answers "near" queries like the memory backend.
+Run from the repository root: python -m pytest -q
+"""
+import os
+import random
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+from test_matching import synthetic_catalog  # noqa: E402
+
+
+def test_sqlite_codes_near_matches_memory(tmp_path):
+    df = synthetic_catalog(300, seed=2)
+    # Codes sharing a family and number with another ('PR-401' and 'PR401') tie on distance
+    twins = df.iloc[:40].copy()
+    twins['Access Code'] = twins['Access Code'].str.replace('-', '')
+    df = pd.concat([df, twins], ignore_index=True).sample(frac=1, random_state=4).reset_index(drop=True)
+    path = tmp_path / 'catalog.csv'
+    df.to_csv(path, index=False)
+
+    kb = app.KnowledgeBase(df.copy(), 'memory')
+    sqlite_kb = app.build_sqlite_knowledge_base(str(path))
+    rnd = random.Random(1)
+    for _ in range(300):
+        number, family, count = rnd.randint(-5, 1100), rnd.choice([None, 'PR', 'SC', 'ZZ']), rnd.choice([1, 5, 12])
+        assert sqlite_kb.codes_near(number, family, count) == kb.codes_near(number, family, count), (number, family, count)